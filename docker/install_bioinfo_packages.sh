@@ -11,3 +11,6 @@ rm bowtie2-2.2.6-linux-x86_64.zip
 curl -L "http://www.bioinformatics.bbsrc.ac.uk/projects/bismark/bismark_v0.14.5.tar.gz" > /bismark_v0.14.5.tar.gz
 tar zxvf /bismark_v0.14.5.tar.gz -C /
 rm /bismark_v0.14.5.tar.gz
+# Add bedGraphToBigWig
+curl -L "http://hgdownload.soe.ucsc.edu/admin/exe/linux.x86_64/bedGraphToBigWig" > /usr/local/bin/bedGraphToBigWig
+chmod +x /usr/local/bin/bedGraphToBigWig
@@ -0,0 +1,284 @@
+GZIP_MAGIC = '\x1f\x8b'
+READ_BUFFER_SIZE = 1024 * 1024
+BGZF_BATCH_BLOCKS = 64
+
+def is_bgzf(filename):
+    ''' Check if a file is in BGZF, the blocked gzip format made by bgzip.
+
+    Parameters
+    ----------
+    filename : str
+        The filename.
+
+    Returns
+    -------
+    bool
+        True if the first block has the BGZF "BC" extra field.
+    '''
+    import struct
+
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if len(header)<12 or header[:2]!=GZIP_MAGIC or not ord(header[3]) & 4:
+            return False
+        xlen = struct.unpack('<H', header[10:12])[0]
+        return get_bgzf_block_size(f.read(xlen)) is not None
+
+def get_bgzf_block_size(extra):
+    ''' Get the BSIZE of a BGZF block from its gzip extra field.
+
+    Parameters
+    ----------
+    extra : str
+        The gzip extra field.
+
+    Returns
+    -------
+    int
+        The total block size minus 1, or None if there is no "BC" subfield.
+    '''
+    import struct
+
+    pos = 0
+    while pos+4<=len(extra):
+        subfield_id = extra[pos:pos+2]
+        subfield_len = struct.unpack('<H', extra[pos+2:pos+4])[0]
+        if subfield_id=='BC' and subfield_len==2:
+            return struct.unpack('<H', extra[pos+4:pos+6])[0]
+        pos += 4 + subfield_len
+    return None
+
+def read_bgzf_block(f):
+    ''' Read one compressed BGZF block.
+
+    Parameters
+    ----------
+    f : file
+        The BGZF file opened in binary mode.
+
+    Returns
+    -------
+    str
+        The whole compressed block, or None at the end of the file.
+    '''
+    import struct
+
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header)<12 or header[:2]!=GZIP_MAGIC or not ord(header[3]) & 4:
+        raise Exception('Not a BGZF block at offset {}'.format(f.tell() - len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = f.read(xlen)
+    block_size = get_bgzf_block_size(extra)
+    if block_size is None:
+        raise Exception('Not a BGZF block at offset {}'.format(f.tell() - 12 - len(extra)))
+    rest = f.read(block_size + 1 - 12 - xlen)
+    if len(rest)!=block_size + 1 - 12 - xlen:
+        raise Exception('Truncated BGZF block at the end of the file.')
+    return header + extra + rest
+
+def inflate_bgzf_block(block):
+    ''' Decompress one BGZF block and check its CRC.
+
+    Parameters
+    ----------
+    block : str
+        The compressed block from read_bgzf_block().
+
+    Returns
+    -------
+    str
+        The decompressed data.
+    '''
+    import zlib
+
+    return zlib.decompress(block, 16 + zlib.MAX_WBITS)
+
+def produce_bgzf_buffers(f, put, threads):
+    ''' Decompress a BGZF file in parallel, a batch of blocks at a time.
+
+    Parameters
+    ----------
+    f : file
+        The BGZF file opened in binary mode.
+    put : function
+        Called with each decompressed buffer. Returns False to stop.
+    threads : int
+        The number of threads which decompress blocks.
+
+    Notes
+    -----
+    * zlib releases the GIL while it inflates, so the blocks are decompressed in
+      parallel. The next batch is read while the current one is decompressed.
+    '''
+    from multiprocessing.pool import ThreadPool
+
+    def read_batch():
+        batch = []
+        while len(batch)<BGZF_BATCH_BLOCKS:
+            block = read_bgzf_block(f)
+            if block is None:
+                break
+            batch.append(block)
+        return batch
+
+    pool = ThreadPool(threads)
+    try:
+        batch = read_batch()
+        while batch:
+            pending = pool.map_async(inflate_bgzf_block, batch)
+            batch = read_batch()
+            if not put(''.join(pending.get())):
+                return
+    finally:
+        pool.terminate()
+
+def produce_gzip_buffers(f, put):
+    ''' Decompress a gzip file, including files of several concatenated members.
+
+    Parameters
+    ----------
+    f : file
+        The gzip file opened in binary mode.
+    put : function
+        Called with each decompressed buffer. Returns False to stop.
+    '''
+    import zlib
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = f.read(READ_BUFFER_SIZE)
+        if not data:
+            break
+        buffers = []
+        while data:
+            buffers.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+            if data:
+                buffers.append(decompressor.flush())
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if not put(''.join(buffers)):
+            return
+    put(decompressor.flush())
+
+def decompress_to_pipe(filename, fd, threads=1, errors=None):
+    ''' Decompress a gzip or BGZF file into a pipe.
+
+    Parameters
+    ----------
+    filename : str
+        The gzip or BGZF filename.
+    fd : int
+        The write end of the pipe. It is closed at the end.
+    threads : int, optional
+        The number of threads which decompress BGZF blocks. A plain gzip file can
+        only be decompressed by one thread.
+    errors : list, optional
+        If given, an exception while reading or decompressing is appended to it.
+
+    Notes
+    -----
+    * It stops without an error when the read end is closed, eg: the caller
+    does not read to the end.
+    '''
+    import errno
+    import os
+
+    def put(data):
+        view = memoryview(data)
+        try:
+            while len(view):
+                view = view[os.write(fd, view):]
+        except OSError as e:
+            if e.errno!=errno.EPIPE:
+                raise
+            return False
+        return True
+
+    try:
+        with open(filename, 'rb') as f:
+            if is_bgzf(filename):
+                produce_bgzf_buffers(f, put, threads)
+            else:
+                produce_gzip_buffers(f, put)
+    except Exception as e:
+        if errors is not None:
+            errors.append(e)
+    finally:
+        os.close(fd)
+
+def read_gzip_fastq(filename, threads=1):
+    ''' Read a gzip or BGZF Fastq file, decompressing it in background threads.
+
+    Parameters
+    ----------
+    filename : str
+        The gzip or BGZF Fastq filename.
+    threads : int, optional
+        The number of threads which decompress BGZF blocks.
+
+    Yields
+    ------
+    pysam.FastqProxy
+        with name, comment, sequence and quality.
+
+    Notes
+    -----
+    * The file is decompressed into a pipe which pysam.FastxFile parses, so the
+    decompression overlaps with parsing and with the caller.
+    '''
+    import os
+    import threading
+    import pysam
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+    thread = threading.Thread(target=decompress_to_pipe,
+        args=(filename, write_fd, threads, errors))
+    thread.daemon = True
+    thread.start()
+    try:
+        fastq_file = pysam.FastxFile('/dev/fd/{}'.format(read_fd))
+    finally:
+        # pysam opened its own copy of the read end.
+        os.close(read_fd)
+    try:
+        for read in fastq_file:
+            yield read
+    finally:
+        # Also stops the decompression when the caller does not read to the end.
+        fastq_file.close()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def read_fastq(filename, threads=1):
+    ''' Read a Fastq file.
+
+    Parameters
+    ----------
+    filename : str
+        The Fastq filename. Plain text, gzip or BGZF.
+    threads : int, optional
+        The number of threads which decompress BGZF blocks.
+
+    Returns
+    -------
+    iterator
+        of pysam.FastqProxy with name, comment, sequence and quality. It has
+        next() and close().
+
+    Notes
+    -----
+    * Plain text files are read by pysam.FastxFile directly. Compressed files are
+    decompressed by read_gzip_fastq(), because pysam.FastxFile only reads the
+    first member of concatenated gzip files, eg: lanes joined by cat.
+    '''
+    import pysam
+
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic==GZIP_MAGIC:
+        return read_gzip_fastq(filename, threads)
+    return pysam.FastxFile(filename)
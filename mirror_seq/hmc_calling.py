@@ -7,6 +7,16 @@ BISMARK_METH_CODE_TYPE_MAP = {
     "z": "CpG",
 }
 
+TABLE_COLUMNS = ['chrom', 'pos', 'strand', 'meth_count', 'total_count']
+
+# The order of methylation codes in the site keys of stream_meth_call().
+STREAM_METH_CODES = 'ZXH'
+SITE_KEY_POS_BITS = 33
+SPILL_DTYPE = [('key', '<i8'), ('meth_count', '<u4'), ('total_count', '<u4')]
+
+# The memory per read of a regions chunk before any chunk is finished.
+DEFAULT_MEMORY_PER_READ_KB = 4.0
+
 def meth_call_for_read(read, overlap=True, min_qual=20):
     ''' Do methyltaion calling per read.
 
@@ -38,28 +48,257 @@ def meth_call_for_read(read, overlap=True, min_qual=20):
     sites instead.
     '''
 
-    if read.is_paired:
-        if read.flag in (99, 147):
+    return meth_call_for_read_fields(read.reference_id, read.flag, read.reference_start,
+        read.next_reference_start, read.get_reference_positions(), read.get_tag('XM'),
+        read.query_qualities, overlap, min_qual)
+
+def meth_call_for_read_fields(reference_id, flag, reference_start, next_reference_start,
+    positions, meth_codes, quals, overlap=True, min_qual=20):
+    ''' Do methyltaion calling with the fields of a read. See meth_call_for_read().
+
+    Parameters
+    ----------
+    reference_id : int
+        The reference ID of the read.
+    flag : int
+        The SAM flag of the read.
+    reference_start : int
+        The start position of the read.
+    next_reference_start : int
+        The start position of the mate.
+    positions : List of int
+        The reference positions of the aligned bases.
+    meth_codes : str
+        The Bismark methylation call string (XM tag).
+    quals : array
+        The base quality scores.
+    overlap : bool
+        If it is True, only count the sites in read 2 for overlapped region.
+    min_qual : int
+        The minium quality score to do methyltaion calling.
+
+    yields
+    -------
+    int
+        reference ID
+    int
+        position
+    str
+        strand
+    str
+        methylation code
+    '''
+
+    is_paired = flag & 0x1
+    if is_paired:
+        if flag in (99, 147):
             strand = '+'
         else:
             strand = '-'
     else:
-        if read.is_reverse:
+        if flag & 0x10:
             strand = '-'
         else:
             strand = '+'
 
-    positions = read.get_reference_positions()
-    is_left = read.reference_start < read.next_reference_start
-    meth_codes = read.get_tag('XM')
-    quals = read.query_qualities
+    is_left = reference_start < next_reference_start
     for pos, meth_code, qual in zip(positions, meth_codes, quals):
         if meth_code in BISMARK_METH_CODE_TYPE_MAP and qual>=min_qual:
-            if read.is_paired and overlap and pos>=read.next_reference_start and is_left:
+            if is_paired and overlap and pos>=next_reference_start and is_left:
+                continue
+            yield reference_id, pos, strand, meth_code
+
+def get_read_fields(read):
+    ''' Get the fields of a read needed by methylation calling.
+
+    Parameters
+    ----------
+    read : pysam.AlignedSegment
+        The read.
+
+    Returns
+    -------
+    tuple
+        (reference_id, flag, reference_start, next_reference_start, cigartuples,
+        meth_codes, quals). Unlike the read, it can be sent to other processes.
+    '''
+    return (read.reference_id, read.flag, read.reference_start, read.next_reference_start,
+        read.cigartuples, read.get_tag('XM'), read.query_qualities)
+
+def get_reference_positions(reference_start, cigartuples):
+    ''' Get the reference positions of the aligned bases from CIGAR.
+
+    Parameters
+    ----------
+    reference_start : int
+        The start position of the read.
+    cigartuples : List of tuples
+        The (operation, length) of CIGAR.
+
+    Returns
+    -------
+    List of int
+        The same as pysam.AlignedSegment.get_reference_positions().
+    '''
+    positions = []
+    pos = reference_start
+    for op, length in cigartuples:
+        # M, = and X consume both the read and the reference.
+        if op in (0, 7, 8):
+            positions.extend(xrange(pos, pos+length))
+            pos += length
+        # D and N only consume the reference.
+        elif op in (2, 3):
+            pos += length
+    return positions
+
+def open_alignment_file(bam_filename, reference_filename=None, threads=1):
+    ''' Open a BAM or CRAM file.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM or CRAM filename.
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+
+    Returns
+    -------
+    pysam.AlignmentFile
+    '''
+    import pysam
+
+    kwargs = {}
+    if reference_filename:
+        kwargs['reference_filename'] = reference_filename
+    if threads>1:
+        kwargs['threads'] = threads
+    return pysam.AlignmentFile(bam_filename, **kwargs)
+
+def get_ref_cache_path(ref_cache_dir):
+    ''' Get the htslib REF_CACHE path of a reference cache folder.
+
+    Parameters
+    ----------
+    ref_cache_dir : str
+        The reference cache folder.
+
+    Returns
+    -------
+    str
+        The path template with the MD5 checksum split into <2>/<2>/<28> characters.
+    '''
+    import os
+
+    return os.path.join(os.path.abspath(ref_cache_dir), '%2s', '%2s', '%s')
+
+def populate_ref_cache(reference_filename, ref_cache_dir):
+    ''' Put the sequences of a reference FASTA into an htslib reference cache.
+
+    Parameters
+    ----------
+    reference_filename : str
+        The reference FASTA filename.
+    ref_cache_dir : str
+        The reference cache folder. It can be shared by runs and machines.
+
+    Returns
+    -------
+    int
+        Number of sequences added to the cache.
+
+    Notes
+    -----
+    * The cached sequences are memory-mapped by htslib, so all workers share one
+    copy of the reference instead of loading it from the FASTA separately.
+    * Sequences already in the cache are skipped. Files are written to a
+    temporary name first so concurrent runs do not see partial sequences.
+    * Files get the permissions of a normally created file, eg: 0644 with umask
+    022, so other users sharing the cache can read them.
+    '''
+    import hashlib
+    import os
+    import pysam
+    import tempfile
+
+    # Temporary files are private, so give the cache files the mode open() would.
+    umask = os.umask(0)
+    os.umask(umask)
+    file_mode = 0o666 & ~umask
+    added = 0
+    with pysam.FastaFile(reference_filename) as fasta_file:
+        for reference in fasta_file.references:
+            seq = fasta_file.fetch(reference).upper()
+            md5 = hashlib.md5(seq).hexdigest()
+            cache_filename = os.path.join(ref_cache_dir, md5[:2], md5[2:4], md5[4:])
+            if os.path.exists(cache_filename):
                 continue
-            yield read.reference_id, pos, strand, meth_code
+            cache_folder = os.path.dirname(cache_filename)
+            if not os.path.isdir(cache_folder):
+                try:
+                    os.makedirs(cache_folder)
+                except OSError:
+                    if not os.path.isdir(cache_folder):
+                        raise
+            with tempfile.NamedTemporaryFile(dir=cache_folder, delete=False) as fw:
+                fw.write(seq)
+            os.chmod(fw.name, file_mode)
+            os.rename(fw.name, cache_filename)
+            added += 1
+    return added
+
+def use_ref_cache(ref_cache_dir):
+    ''' Let htslib look up and store CRAM reference sequences in a cache folder.
+
+    Parameters
+    ----------
+    ref_cache_dir : str
+        The reference cache folder.
+
+    Notes
+    -----
+    * It sets REF_CACHE and REF_PATH environment variables, so call it before
+    starting worker processes.
+    '''
+    import os
+
+    ref_cache_path = get_ref_cache_path(ref_cache_dir)
+    os.environ['REF_CACHE'] = ref_cache_path
+    ref_path = os.environ.get('REF_PATH')
+    if not ref_path:
+        os.environ['REF_PATH'] = ref_cache_path
+    elif ref_cache_path not in ref_path.split(':'):
+        os.environ['REF_PATH'] = '{}:{}'.format(ref_cache_path, ref_path)
+
+def get_worker_threads(processes=None, threads=None):
+    ''' Split a thread budget between calling processes and their decompression threads.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of calling processes. Default is the thread budget.
+    threads : int, optional
+        The total thread budget. Default is the number of CPUs.
+
+    Returns
+    -------
+    int
+        Number of calling processes.
+    int
+        Number of htslib decompression threads of each process.
+    '''
+    import multiprocessing
+
+    if not threads:
+        threads = processes or multiprocessing.cpu_count()
+    if not processes:
+        processes = threads
+    return processes, max(1, threads // processes)
 
-def meth_call_by_region(bam_filename, chrom=None, start=None, end=None):
+def meth_call_by_region(bam_filename, chrom=None, start=None, end=None, metrics=None,
+    max_depth=None, reference_filename=None, threads=1):
     ''' Methylation call for a given region.
 
     Parameters
@@ -72,31 +311,128 @@ def meth_call_by_region(bam_filename, chrom=None, start=None, end=None):
         The start position of the region.
     end : int, optional
         The end position of the region.
+    metrics : List, optional
+        If given, append the metrics record of this region to it.
+    max_depth : int, optional
+        If given, skip the reads starting at a position already covered by
+        max_depth kept reads. Both mates of a pair are kept or skipped together.
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
 
     Returns
     -------
     pandas.DataFrame
         columns is ['chrom', 'pos', 'strand', 'meth_code', 'meth_count', 'total_count'].
+
+    Notes
+    -----
+    * Reads come in coordinate order so the skipped reads are the same in every run.
+    * The mate which comes first decides for the pair, because read 1 leaves the
+    calls where the mates overlap to read 2. See meth_call_for_read().
+    '''
+    return meth_call_by_regions(bam_filename, [(chrom, start, end)], metrics, max_depth,
+        reference_filename, threads)
+
+def meth_call_by_regions(bam_filename, regions, metrics=None, max_depth=None,
+    reference_filename=None, threads=1):
+    ''' Methylation call for a list of regions in one pass.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM filename.
+    regions : List of tuples
+        A list of (chromosome, start, end). start and end can be None for the
+        whole chromosome.
+    metrics : List, optional
+        If given, append the metrics record of these regions to it.
+    max_depth : int, optional
+        The maximum read depth of every region. See meth_call_by_region().
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        columns is ['chrom', 'pos', 'strand', 'meth_code', 'meth_count', 'total_count'],
+        sorted by chromosome index, position and strand.
+
+    Notes
+    -----
+    * The file is opened once and the calls of all regions are added up in one
+    dict, so many small contigs cost about the same as one contig of their
+    total size.
     '''
 
     import pandas as pd
     import pysam
     import numpy as np
+    import time
+    import heapq
+    from mirror_seq import metrics as mt
 
-    print 'Working on {}:{}-{}'.format(chrom, start, end)
-    with pysam.AlignmentFile(bam_filename) as samfile:
-        tid_chrom_d = {i: d['SN'] for i, d in enumerate(samfile.header['SQ'])}
+    start_time = time.time()
+    if len(regions)==1:
+        print 'Working on {}:{}-{}'.format(*regions[0])
+    else:
+        print 'Working on {} regions from {}:{}-{}'.format(len(regions), *regions[0])
+    read_count = 0
+    skipped_count = 0
+    bytes_read = 0
+    with open_alignment_file(bam_filename, reference_filename, threads) as samfile:
+        chroms = samfile.references
+        # Only BAM has BGZF virtual offsets to count the bytes read.
+        track_offsets = samfile.is_bam
         # Values are tuples of meth_count and totoal counts.
         coor_meth_calls_d = {}
-        for read in samfile.fetch(chrom, start, end):
-            for reference_id, pos, strand, meth_code in meth_call_for_read(read):
-                meth_calls = coor_meth_calls_d.setdefault(
-                    (reference_id, pos, strand, meth_code.upper()),
-                    [0, 0]
-                )
-                if meth_code.isupper():
-                    meth_calls[0] += 1
-                meth_calls[1] += 1
+        for chrom, start, end in regions:
+            # The end of a region is included, so also fetch the reads starting at it.
+            fetch_end = end + 1 if end!=None else None
+            min_pos = start if start!=None else 0
+            max_pos = end if end!=None else float('inf')
+            # The end positions of kept reads which may still cover the current read start.
+            kept_read_ends = []
+            # Keys are the names of the pairs whose other mate comes later, and values
+            # are whether the first mate was kept.
+            pair_kept_d = {}
+            first_offset = None
+            for read in samfile.fetch(chrom, start, fetch_end):
+                if first_offset is None and track_offsets:
+                    first_offset = samfile.tell()
+                read_count += 1
+                if max_depth:
+                    read_start = read.reference_start
+                    while kept_read_ends and kept_read_ends[0]<=read_start:
+                        heapq.heappop(kept_read_ends)
+                    is_kept = pair_kept_d.pop(read.query_name, None)
+                    if is_kept is None:
+                        is_kept = len(kept_read_ends)<max_depth
+                        if (read.is_paired and not read.mate_is_unmapped
+                            and read.next_reference_id==read.reference_id
+                            and read.next_reference_start>=read_start):
+                            pair_kept_d[read.query_name] = is_kept
+                    if not is_kept:
+                        skipped_count += 1
+                        continue
+                    heapq.heappush(kept_read_ends, read.reference_end)
+                for reference_id, pos, strand, meth_code in meth_call_for_read(read):
+                    # Calls outside the region belong to the neighbouring regions.
+                    if not min_pos<=pos<=max_pos:
+                        continue
+                    meth_calls = coor_meth_calls_d.setdefault(
+                        (reference_id, pos, strand, meth_code.upper()),
+                        [0, 0]
+                    )
+                    if meth_code.isupper():
+                        meth_calls[0] += 1
+                    meth_calls[1] += 1
+            # BGZF virtual offsets keep the compressed offset in the upper 48 bits.
+            if first_offset is not None:
+                bytes_read += (samfile.tell() >> 16) - (first_offset >> 16)
 
     result_df = pd.DataFrame()
     if coor_meth_calls_d:
@@ -110,18 +446,64 @@ def meth_call_by_region(bam_filename, chrom=None, start=None, end=None):
             dtype=np.uint32,
         )
         result_df.reset_index(inplace=True)
-        result_df['chrom'] = result_df['chrom'].astype(np.uint32)
         result_df.sort_values(['chrom', 'pos', 'strand'], inplace=True)
-        if start!=None:
-            idx_start = result_df['pos'].searchsorted(start, 'left')[0]
-            result_df = result_df[idx_start:]
-        if end!=None:
-            idx_end = result_df['pos'].searchsorted(end, 'right')[0]
-            result_df = result_df[:idx_end]
-        result_df['chrom'] = result_df['chrom'].replace(tid_chrom_d)
+        result_df['chrom'] = np.asarray(chroms, dtype=object)[result_df['chrom'].values]
+
+    if metrics is not None:
+        metrics.append(mt.make_record(
+            'calling_region',
+            start_time,
+            name='{}:{}-{}'.format(*regions[0]),
+            regions=len(regions),
+            reads=read_count,
+            reads_skipped=skipped_count,
+            sites=len(result_df),
+            bytes_read=bytes_read,
+        ))
     return result_df
 
-def write_meth_data_by_regions(bam_filename, out_dir, regions, rand_str=''):
+def write_meth_tables(result_df, out_dir, rand_str=''):
+    ''' Write the methylation calling DataFrame into a temp file per methylation type.
+
+    Parameters
+    ----------
+    result_df : pandas.DataFrame
+        The DataFrame from meth_call_by_region().
+    out_dir : str
+        The ouput directory.
+    rand_str : str, optional
+        Add the rand_str in the prefix to tempfiles.
+
+    Returns
+    -------
+    int
+        The number of bytes written.
+    '''
+    import tempfile
+    from mirror_seq import metrics as mt
+
+    bytes_written = 0
+    for meth_code in result_df['meth_code'].unique():
+        meth_type = BISMARK_METH_CODE_TYPE_MAP[meth_code]
+        tmp_df = result_df[result_df['meth_code']==meth_code]
+        tmp_df = tmp_df[TABLE_COLUMNS]
+        tmp_df = tmp_df.reset_index(drop=True)
+        # Mirror-seq can only detect CpGs so do not convert non-CpGs.
+        if meth_code=='Z':
+            mirror_seq_conversion(tmp_df)
+        # Every table is sorted by chromosome name, position and strand so
+        # they can be merged by merge_sorted_tables().
+        tmp_df.sort_values(['chrom', 'pos', 'strand'], inplace=True)
+
+        prefix = 'tmp_{0}_'.format(rand_str)
+        suffix = '_{0}'.format(meth_type)
+        f = tempfile.NamedTemporaryFile(dir=out_dir, prefix=prefix, suffix=suffix, delete=False)
+        tmp_df.to_csv(f.name, compression='gzip', index=False)
+        bytes_written += mt.get_file_size(f.name)
+    return bytes_written
+
+def write_meth_data_by_regions(bam_filename, out_dir, regions, rand_str='', max_depth=None,
+    reference_filename=None, threads=1, spill=False):
     ''' Write the region methylation calling DataFrame into a file.
 
     Parameters
@@ -134,6 +516,21 @@ def write_meth_data_by_regions(bam_filename, out_dir, regions, rand_str=''):
         A list of (chromosome, start, end).
     rand_str : str, optional
         Add the rand_str in the prefix to tempfiles.
+    max_depth : int, optional
+        The maximum read depth. See meth_call_by_region().
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+    spill : bool, optional
+        If True, write the calls of every region to disk before calling the
+        next region, so only one region is in memory.
+
+    Returns
+    -------
+    List of dict
+        The metrics records of the regions and of the whole chunk. The chunk
+        record also has the peak RSS when the chunk started, "start_peak_rss_kb".
 
     Notes
     -----
@@ -141,198 +538,1125 @@ def write_meth_data_by_regions(bam_filename, out_dir, regions, rand_str=''):
     '''
 
     import pandas as pd
-    import tempfile
     import pysam
+    import time
+    from mirror_seq import metrics as mt
 
+    start_time = time.time()
+    start_peak_rss = mt.get_peak_rss()
+    records = []
     result_df = pd.DataFrame()
-    for chrom, start, end in regions:
-        result_df = result_df.append(meth_call_by_region(bam_filename, chrom, start, end))
+    sites = 0
+    bytes_written = 0
+    # Without spill, all regions are called in one pass, eg: a batch of small contigs.
+    regions_batches = [[region] for region in regions] if spill else [regions]
+    for regions_batch in regions_batches:
+        result_df = result_df.append(meth_call_by_regions(bam_filename, regions_batch,
+            metrics=records, max_depth=max_depth, reference_filename=reference_filename,
+            threads=threads))
+        if spill and not result_df.empty:
+            sites += len(result_df)
+            bytes_written += write_meth_tables(result_df, out_dir, rand_str)
+            result_df = pd.DataFrame()
 
     if not result_df.empty:
-        for meth_code in result_df['meth_code'].unique():
-            meth_type = BISMARK_METH_CODE_TYPE_MAP[meth_code]
-            tmp_df = result_df[result_df['meth_code']==meth_code]
-            tmp_df = tmp_df[['chrom', 'pos', 'strand', 'meth_count', 'total_count']]
-            tmp_df = tmp_df.reset_index(drop=True)
-            # Mirror-seq can only detect CpGs so do not convert non-CpGs.
-            if meth_code=='Z':
-                mirror_seq_conversion(tmp_df)
+        sites += len(result_df)
+        bytes_written += write_meth_tables(result_df, out_dir, rand_str)
 
-            prefix = 'tmp_{0}_'.format(rand_str)
-            suffix = '_{0}'.format(meth_type)
-            f = tempfile.NamedTemporaryFile(dir=out_dir, prefix=prefix, suffix=suffix, delete=False)
-            tmp_df.to_csv(f.name, compression='gzip', index=False)
+    records.append(mt.make_record(
+        'calling_chunk',
+        start_time,
+        name='{}:{}-{}'.format(*regions[0]),
+        regions=len(regions),
+        reads=sum(r['reads'] for r in records),
+        reads_skipped=sum(r['reads_skipped'] for r in records),
+        sites=sites,
+        bytes_read=sum(r['bytes_read'] for r in records),
+        bytes_written=bytes_written,
+        start_peak_rss_kb=start_peak_rss,
+    ))
+    return records
 
-def get_regions_chunks(bam_filename, nts_in_regions=100000000):
-    ''' Iterate regions lists to roughly fit "nts_in_regions".
+def encode_site_key(reference_id, pos, strand, meth_code):
+    ''' Encode a methylation call as an integer key sorted by site.
 
     Parameters
     ----------
-    bam_filename : str
-        The alignment BAM filename.
-    nts_in_regions : int, optional
-        Number of total nucleotides in an iter of regions. It is an rough number
-        so it is possible to get more than the number.
+    reference_id : int
+        The reference ID.
+    pos : int
+        The position.
+    strand : str
+        + or -.
+    meth_code : str
+        The upper case methylation code. Eg: Z, X and H.
 
-    Yields
-    ------
-    List
-        List of tuples of chromosome, start, and end.
+    Returns
+    -------
+    int
+        The key. Sorting keys sorts sites by reference ID, position, methylation
+        code and strand.
     '''
-    import pysam
-
-    with pysam.AlignmentFile(bam_filename) as samfile:
-        chrom_sizes = [(d['SN'], d['LN']) for d in samfile.header['SQ']]
-        chrom_sizes = sorted(chrom_sizes, key=lambda x: x[1], reverse=True)
-
-    regions = []
-    nts = 0
-    for chrom, size in chrom_sizes:
-        chunk_num = size / nts_in_regions
-        if size % nts_in_regions != 0:
-            chunk_num += 1
-
-        start = 0
-        for i in range(chunk_num):
-            end = min(start + nts_in_regions, size)
-            region_size = end - start
-            nts += region_size
-            regions.append((chrom, start, end))
-            if nts>nts_in_regions:
-                yield regions
-                nts = 0
-                regions = []
-            start = end + 1
-    if regions:
-        yield regions
+    # Shift positions by one so converted CpGs at position 0 (-1) still fit.
+    return ((reference_id << SITE_KEY_POS_BITS + 3) | ((pos + 1) << 3)
+        | (STREAM_METH_CODES.index(meth_code) << 1) | (strand=='-'))
 
-def parse_to_bed(data_filename, bed_filename, chunksize=1000000):
-    ''' Parse the standard output format to BED format.
+def write_meth_data_by_read_batch(read_batch, out_dir, rand_str, bucket_size):
+    ''' Call a batch of reads in any order and spill the counts into coordinate buckets.
 
     Parameters
     ----------
-    data_filename : str
-        The data filename.
-    bed_filename : str
-        The output BED filename.
-    chunksize : int, optional
-        The chunk size when reading files.
+    read_batch : List of tuples
+        The read fields from get_read_fields().
+    out_dir : str
+        The ouput directory.
+    rand_str : str
+        Add the rand_str in the prefix to tempfiles.
+    bucket_size : int
+        Number of nucleotides in a bucket.
+
+    Returns
+    -------
+    dict
+        The metrics record of this batch.
+
+    Notes
+    -----
+    * CpGs are converted by mirror_seq_conversion() per call, so the buckets can
+    be summed directly.
+    * The counts are appended to tmp_<RAND_STR>_b<REFERENCE_ID>_<BUCKET>_<PID> files,
+    which are merged by merge_meth_data_bucket().
     '''
-    import pandas as pd
     import numpy as np
-    import subprocess
     import os
+    import time
+    from mirror_seq import metrics as mt
 
-    with open(bed_filename, 'w') as fw:
-        for df in pd.read_csv(data_filename, chunksize=chunksize):
-            df['end'] = df['pos'] + 1
-            df['thick_start'] = 0
-            df['thick_end'] = 0
-            df['meth_ratio'] = df['meth_count'] / df['total_count']
-            df['score'] = (df['meth_ratio'] * 1000).round().astype(np.uint32)
-            df['name'] = df.apply(
-                lambda r: '{0}/{1}({2:.0%})'.format(
-                    r['meth_count'],
-                    r['total_count'],
-                    r['meth_ratio']
-                ),
-                axis=1,
-            )
-            df['rgb'] = df.apply(
-                lambda r: '255,{0:.0f},0'.format(255*r['meth_ratio']),
-                axis=1,
-            )
-
-            colnames = [
-                'chrom',
-                'pos',
-                'end',
-                'name',
-                'score',
-                'strand',
-                'thick_start',
-                'thick_end',
-                'rgb'
-            ]
-            df[colnames].to_csv(fw, sep='\t', index=False, header=False)
-    temp_folder = os.path.dirname(bed_filename)
-    subprocess.check_call((
-        "sort",
-        "-T", temp_folder,
-        "-k1,1",
-        "-k2,2n",
-        bed_filename,
-        "-o", bed_filename,
-    ))
-    subprocess.check_call(('gzip', '-f', bed_filename))
+    start_time = time.time()
+    keys = []
+    meth_flags = []
+    for reference_id, flag, reference_start, next_reference_start, cigartuples, \
+        meth_codes, quals in read_batch:
+        positions = get_reference_positions(reference_start, cigartuples)
+        for _, pos, strand, meth_code in meth_call_for_read_fields(reference_id, flag,
+            reference_start, next_reference_start, positions, meth_codes, quals):
+            is_meth = meth_code.isupper()
+            meth_code = meth_code.upper()
+            if meth_code=='Z':
+                if strand=='+':
+                    pos += 1
+                    strand = '-'
+                else:
+                    pos -= 1
+                    strand = '+'
+                is_meth = not is_meth
+            keys.append(encode_site_key(reference_id, pos, strand, meth_code))
+            meth_flags.append(is_meth)
 
-def mirror_seq_conversion(df):
-    ''' Convert methylation ratios and strands.
+    site_keys, inverse = np.unique(np.array(keys, dtype=np.int64), return_inverse=True)
+    sites = np.zeros(len(site_keys), dtype=SPILL_DTYPE)
+    sites['key'] = site_keys
+    sites['meth_count'] = np.bincount(inverse, weights=np.array(meth_flags, dtype=np.float64),
+        minlength=len(site_keys))
+    sites['total_count'] = np.bincount(inverse, minlength=len(site_keys))
 
-    Parameters
-    ----------
-    df : pandas.DataFrame
-        with columns - strand, pos, meth_count, and total_count.
-    '''
-    import pandas as pd
+    # Keys are sorted so each bucket is a contiguous slice.
+    reference_ids = site_keys >> SITE_KEY_POS_BITS + 3
+    buckets = ((site_keys >> 3) & (2**SITE_KEY_POS_BITS - 1)) // bucket_size
+    boundaries = np.flatnonzero((np.diff(reference_ids)!=0) | (np.diff(buckets)!=0)) + 1
+    bytes_written = 0
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(sites)]):
+        if start==end:
+            continue
+        filename = os.path.join(out_dir, 'tmp_{}_b{}_{}_{}'.format(
+            rand_str, reference_ids[start], buckets[start], os.getpid()))
+        with open(filename, 'ab') as fw:
+            sites[start:end].tofile(fw)
+        bytes_written += sites[start:end].nbytes
 
-    pos_series = pd.concat((
-        df[df['strand']=='+']['pos'] + 1,
-        df[df['strand']=='-']['pos'] - 1,
-    ))
-    df['pos'] = pos_series
-    df['strand'] = df['strand'].replace({'+': '--', '-': '++'}).replace({'--': '-', '++': '+'})
-    df['meth_count'] = df['total_count'] - df['meth_count']
+    return mt.make_record(
+        'calling_batch',
+        start_time,
+        reads=len(read_batch),
+        sites=len(sites),
+        bytes_written=bytes_written,
+    )
 
-def merge_n_parse(out_prefix, meth_type, filenames, create_bed_file):
-    ''' The is a shortcut function, which is easier to be used by multiprocessing.
+def merge_meth_data_bucket(filenames, chrom):
+    ''' Sum the spilled counts of a bucket from all batches.
 
     Parameters
     ----------
-    out_prefix : str
-        The output prefix.
-    meth_type : str
-        The methylation type. Eg: CpG, CHG, and CHH.
-    filenames : str
-        The csv filenames to be mreged.
-    create_bed_file : bool
-        Create a bed file or not.
+    filenames : List of str
+        The spill files of a bucket from write_meth_data_by_read_batch().
+    chrom : str
+        The chromosome name of the bucket.
+
+    Returns
+    -------
+    str
+        The sorted CpG rows in csv without header.
+    float
+        The sum of methylation ratios of non-CpGs.
+    int
+        The number of non-CpGs.
+    dict
+        The metrics record of this bucket.
+
+    Notes
+    -----
+    * The spill files are removed.
     '''
+    import numpy as np
     import pandas as pd
     import os
-    import subprocess
+    import time
+    from mirror_seq import metrics as mt
 
-    full_filename = '{0}_{1}.csv'.format(out_prefix, meth_type)
-    header = True
+    start_time = time.time()
+    bytes_read = sum(mt.get_file_size(filename) for filename in filenames)
+    sites = np.concatenate([np.fromfile(filename, dtype=SPILL_DTYPE) for filename in filenames])
     for filename in filenames:
-        pd.read_csv(filename, compression='gzip').to_csv(full_filename, header=header, mode='a', index=False)
-        header = False
+        os.remove(filename)
+
+    site_keys, inverse = np.unique(sites['key'], return_inverse=True)
+    meth_counts = np.bincount(inverse, weights=sites['meth_count'], minlength=len(site_keys))
+    total_counts = np.bincount(inverse, weights=sites['total_count'], minlength=len(site_keys))
+    code_strands = site_keys & 7
+    is_cpg = (code_strands >> 1)==STREAM_METH_CODES.index('Z')
+
+    cpg_keys = site_keys[is_cpg]
+    df = pd.DataFrame({
+        'chrom': chrom,
+        'pos': ((cpg_keys >> 3) & (2**SITE_KEY_POS_BITS - 1)) - 1,
+        'strand': np.where(cpg_keys & 1, '-', '+'),
+        'meth_count': meth_counts[is_cpg].astype(np.int64),
+        'total_count': total_counts[is_cpg].astype(np.int64),
+    }, columns=TABLE_COLUMNS)
+
+    non_cpg_ratios = meth_counts[~is_cpg] / total_counts[~is_cpg]
+
+    record = mt.make_record(
+        'merge_bucket',
+        start_time,
+        name=chrom,
+        sites=len(site_keys),
+        bytes_read=bytes_read,
+    )
+    return df.to_csv(index=False, header=False), non_cpg_ratios.sum(), len(non_cpg_ratios), record
+
+def stream_meth_call(bam_filename, out_dir, rand_str, cpg_filename, processes=None,
+    threads=1, reference_filename=None, batch_size=100000, bucket_size=5000000,
+    progress=False, include_contigs=None, exclude_contigs=None):
+    ''' Methylation calling by streaming an alignment file in any order, eg: unsorted
+    Bismark output.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM or CRAM filename. It does not need to be sorted or indexed.
+    out_dir : str
+        The ouput directory.
+    rand_str : str
+        Add the rand_str in the prefix to tempfiles.
+    cpg_filename : str
+        The output CpG csv filename. It is sorted and not gzipped.
+    processes : int, optional
+        Number of calling processes. Default is the number of CPUs.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    batch_size : int, optional
+        Number of reads sent to a calling process at a time.
+    bucket_size : int, optional
+        Number of nucleotides in a coordinate bucket. Peak memory of merging
+        is about the number of calls in the largest bucket.
+    progress : bool, optional
+        If True, print the progress and ETA based on the bytes read.
+    include_contigs : List of str, optional
+        Only call the reads on the chromosomes matching these patterns. See
+        filter_chroms().
+    exclude_contigs : List of str, optional
+        Skip the reads on the chromosomes matching these patterns.
+
+    Returns
+    -------
+    float
+        The sum of methylation ratios of non-CpGs.
+    int
+        The number of non-CpGs.
+    List of dict
+        The metrics records.
+
+    Notes
+    -----
+    * Only the reads of processes*2 batches are in memory at the same time.
+    '''
+    from multiprocessing import Pool
+    import multiprocessing
+    import collections
+    import os
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    processes = processes or multiprocessing.cpu_count()
+    total_bytes = mt.get_file_size(bam_filename)
+    records = []
+    p = Pool(processes)
+    pending_results = collections.deque()
+
+    def submit(read_batch):
+        # Wait for the oldest batch so the reads in memory are bounded.
+        if len(pending_results)>=processes*2:
+            records.append(pending_results.popleft().get())
+        pending_results.append(p.apply_async(
+            write_meth_data_by_read_batch,
+            (read_batch, out_dir, rand_str, bucket_size),
+        ))
+
+    read_count = 0
+    with open_alignment_file(bam_filename, reference_filename, threads) as samfile:
+        chroms = [d['SN'] for d in samfile.header['SQ']]
+        kept_chroms = set(filter_chroms(chroms, include_contigs, exclude_contigs))
+        kept_tids = set(tid for tid, chrom in enumerate(chroms) if chrom in kept_chroms)
+        read_batch = []
+        for read in samfile.fetch(until_eof=True):
+            if read.is_unmapped or read.reference_id not in kept_tids:
+                continue
+            read_batch.append(get_read_fields(read))
+            if len(read_batch)>=batch_size:
+                submit(read_batch)
+                read_batch = []
+                if progress and samfile.is_bam:
+                    mt.report_progress(samfile.tell() >> 16, total_bytes, start_time, 'bytes')
+            read_count += 1
+        if read_batch:
+            submit(read_batch)
+    p.close()
+    p.join()
+    records += [result.get() for result in pending_results]
+    records.append(mt.make_record(
+        'calling',
+        start_time,
+        name=bam_filename,
+        reads=read_count,
+        bytes_read=total_bytes,
+    ))
+
+    print('Merge buckets...')
+    bucket_filenames = {}
+    prefix = 'tmp_{}_b'.format(rand_str)
+    for filename in os.listdir(os.path.join('.', out_dir)):
+        if not filename.startswith(prefix):
+            continue
+        reference_id, bucket, _ = filename[len(prefix):].split('_')
+        bucket_filenames.setdefault((int(reference_id), int(bucket)), []).append(
+            os.path.join(out_dir, filename))
+    # Buckets in chromosome name order give the sorted output.
+    bucket_keys = sorted(bucket_filenames, key=lambda k: (chroms[k[0]], k[1]))
+
+    merge_start_time = time.time()
+    meth_ratio_sum = 0
+    count = 0
+    p = Pool(processes)
+    pending_results = collections.deque()
+    with open(cpg_filename, 'w') as fw:
+        fw.write(','.join(TABLE_COLUMNS) + '\n')
+        # Only merge a few buckets ahead of writing to keep the memory bounded.
+        for i in range(len(bucket_keys) + processes):
+            if i<len(bucket_keys):
+                reference_id, bucket = bucket_keys[i]
+                pending_results.append(p.apply_async(
+                    merge_meth_data_bucket,
+                    (bucket_filenames[(reference_id, bucket)], chroms[reference_id]),
+                ))
+            if i>=processes and pending_results:
+                cpg_csv, bucket_meth_ratio_sum, bucket_count, record = \
+                    pending_results.popleft().get()
+                fw.write(cpg_csv)
+                meth_ratio_sum += bucket_meth_ratio_sum
+                count += bucket_count
+                records.append(record)
+    p.close()
+    p.join()
+    records.append(mt.make_record(
+        'merge',
+        merge_start_time,
+        name=cpg_filename,
+        bytes_written=mt.get_file_size(cpg_filename),
+    ))
+    return meth_ratio_sum, count, records
+
+def get_chrom_sizes(bam_filename):
+    ''' Get the chromosome sizes from the header of an alignment file.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM or CRAM filename.
+
+    Returns
+    -------
+    List of tuples
+        (chromosome, size) in the header order.
+    '''
+    with open_alignment_file(bam_filename) as samfile:
+        return [(d['SN'], d['LN']) for d in samfile.header['SQ']]
+
+def read_chrom_sizes(chrom_sizes_filename):
+    ''' Read the chromosome sizes from a chrom.sizes file, eg: from UCSC or
+    "cut -f1,2 genome.fa.fai".
+
+    Parameters
+    ----------
+    chrom_sizes_filename : str
+        The tab-separated file of chromosome names and sizes.
+
+    Returns
+    -------
+    List of tuples
+        (chromosome, size) in the file order.
+    '''
+    chrom_sizes = []
+    with open(chrom_sizes_filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields)<2 or not fields[1].isdigit():
+                raise Exception('Not a chrom.sizes line: {}'.format(line.rstrip()))
+            chrom_sizes.append((fields[0], int(fields[1])))
+    return chrom_sizes
+
+def filter_chroms(chroms, include_contigs=None, exclude_contigs=None):
+    ''' Filter chromosomes by name patterns.
+
+    Parameters
+    ----------
+    chroms : List of str
+        The chromosome names.
+    include_contigs : List of str, optional
+        Shell-style patterns, eg: chr*. If given, only keep the chromosomes
+        matching any of them.
+    exclude_contigs : List of str, optional
+        Shell-style patterns, eg: *_alt. Remove the chromosomes matching any of them.
+
+    Returns
+    -------
+    List of str
+        The kept chromosome names in the same order.
+    '''
+    import fnmatch
+
+    def match(chrom, patterns):
+        return any(fnmatch.fnmatchcase(chrom, pattern) for pattern in patterns)
+
+    if include_contigs:
+        chroms = [chrom for chrom in chroms if match(chrom, include_contigs)]
+    if exclude_contigs:
+        chroms = [chrom for chrom in chroms if not match(chrom, exclude_contigs)]
+    return chroms
+
+def read_targets(bed_filename, padding=0):
+    ''' Read the target regions from a BED file.
+
+    Parameters
+    ----------
+    bed_filename : str
+        The BED filename. Only the first three columns are used. It can be gzipped.
+    padding : int, optional
+        Number of nucleotides added to both sides of every target.
+
+    Returns
+    -------
+    dict
+        Keys are chromosomes and values are the sorted lists of (start, end) of
+        the padded targets. Overlapping or adjacent targets are merged. Like BED,
+        start is 0-based and end is exclusive.
+    '''
+    import gzip
+
+    open_func = gzip.open if bed_filename.endswith('.gz') else open
+    chrom_targets = {}
+    with open_func(bed_filename) as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            chrom_targets.setdefault(chrom, []).append((max(0, start - padding), end + padding))
+
+    for chrom, targets in chrom_targets.iteritems():
+        merged_targets = []
+        for start, end in sorted(targets):
+            if merged_targets and start<=merged_targets[-1][1]:
+                merged_targets[-1] = (merged_targets[-1][0], max(end, merged_targets[-1][1]))
+            else:
+                merged_targets.append((start, end))
+        chrom_targets[chrom] = merged_targets
+    return chrom_targets
+
+def get_regions_chunks(bam_filename, nts_in_regions=100000000, targets=None,
+    include_contigs=None, exclude_contigs=None):
+    ''' Iterate regions lists to roughly fit "nts_in_regions".
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM filename.
+    nts_in_regions : int, optional
+        Number of total nucleotides in an iter of regions. It is an rough number
+        so it is possible to get more than the number.
+    targets : dict, optional
+        The targets from read_targets(). If given, only the targets are covered
+        instead of whole chromosomes.
+    include_contigs : List of str, optional
+        Only cover the chromosomes matching these patterns. See filter_chroms().
+    exclude_contigs : List of str, optional
+        Do not cover the chromosomes matching these patterns. See filter_chroms().
+
+    Yields
+    ------
+    List
+        List of tuples of chromosome, start, and end.
+
+    Notes
+    -----
+    * Chromosomes of at least nts_in_regions go first from the largest. The
+    smaller ones follow in the header order.
+    '''
+    import pysam
+
+    chrom_sizes = get_chrom_sizes(bam_filename)
+    chroms = set(filter_chroms([chrom for chrom, _ in chrom_sizes], include_contigs,
+        exclude_contigs))
+
+    large_chroms = []
+    small_chroms = []
+    for chrom, size in chrom_sizes:
+        if chrom not in chroms:
+            continue
+        # The end of a region is included, so the last region ends before the size.
+        if targets is None:
+            chrom_regions = [(0, size - 1)]
+        else:
+            chrom_regions = [(start, min(end, size) - 1) for start, end in
+                targets.get(chrom, []) if start<size]
+        chrom_nts = sum(end - start + 1 for start, end in chrom_regions)
+        if chrom_nts>=nts_in_regions:
+            large_chroms.append((chrom, chrom_nts, chrom_regions))
+        else:
+            small_chroms.append((chrom, chrom_nts, chrom_regions))
+    # Large chromosomes go first for balanced workers. Small ones are packed in the
+    # header order, so a chunk of them is read in one pass over the file.
+    large_chroms.sort(key=lambda x: x[1], reverse=True)
+
+    regions = []
+    nts = 0
+    for chrom, _, chrom_regions in large_chroms + small_chroms:
+        for start, region_end in chrom_regions:
+            while start<=region_end:
+                end = min(start + nts_in_regions - 1, region_end)
+                nts += end - start + 1
+                regions.append((chrom, start, end))
+                if nts>=nts_in_regions:
+                    yield regions
+                    nts = 0
+                    regions = []
+                start = end + 1
+    if regions:
+        yield regions
+
+def estimate_regions_reads(bam_filename, regions_chunks):
+    ''' Estimate the number of reads in each regions chunk from the BAM index.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM filename.
+    regions_chunks : List of lists
+        The regions lists from get_regions_chunks().
+
+    Returns
+    -------
+    List of float
+        The estimated read count of each regions chunk.
+
+    Notes
+    -----
+    * Reads are assumed to be evenly distributed within a contig.
+    * If the index has no read counts, eg: CRAM, the region lengths are used instead.
+    '''
+    import pysam
+
+    with open_alignment_file(bam_filename) as samfile:
+        chrom_sizes = {d['SN']: d['LN'] for d in samfile.header['SQ']}
+        try:
+            chrom_reads = {stat.contig: stat.mapped for stat in samfile.get_index_statistics()}
+        except (AttributeError, ValueError):
+            chrom_reads = {}
+    if not any(chrom_reads.itervalues()):
+        chrom_reads = {}
+
+    estimates = []
+    for regions in regions_chunks:
+        estimate = 0.0
+        for chrom, start, end in regions:
+            size = chrom_sizes[chrom]
+            region_size = min(end, size) - start
+            if chrom_reads:
+                estimate += chrom_reads.get(chrom, 0) * float(region_size) / max(size, 1)
+            else:
+                estimate += region_size
+        estimates.append(estimate)
+    return estimates
+
+def split_regions_chunk(regions, chunk_count):
+    ''' Split a regions chunk into smaller chunks with about the same nucleotides.
+
+    Parameters
+    ----------
+    regions : List of tuples
+        A list of (chromosome, start, end) from get_regions_chunks().
+    chunk_count : int
+        The number of chunks to split into.
+
+    Returns
+    -------
+    List of lists
+        The regions chunks in the same order. Together they cover the same
+        positions as the input regions.
+    '''
+    # The ends are included, so a region has end - start + 1 positions.
+    total_nts = sum(end - start + 1 for _, start, end in regions)
+    nts_in_regions = max(1, -(-total_nts // chunk_count))
+
+    chunks = []
+    chunk = []
+    nts = 0
+    for chrom, start, end in regions:
+        while start<=end:
+            region_end = min(start + nts_in_regions - nts, end + 1) - 1
+            chunk.append((chrom, start, region_end))
+            nts += region_end - start + 1
+            if nts>=nts_in_regions:
+                chunks.append(chunk)
+                chunk = []
+                nts = 0
+            # The same as get_regions_chunks(), the next region starts after the end.
+            start = region_end + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def parse_memory(memory_str):
+    ''' Parse a memory size string.
+
+    Parameters
+    ----------
+    memory_str : str
+        A number with an optional unit K, M, G or T. Eg: 16G. Megabytes if no unit.
+
+    Returns
+    -------
+    int
+        The memory size in megabytes.
+    '''
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    number = memory_str.strip().upper().rstrip('B')
+    unit = 1
+    if number and number[-1] in units:
+        unit = units[number[-1]]
+        number = number[:-1]
+    try:
+        memory = int(float(number) * unit)
+    except ValueError:
+        raise ValueError('Memory must be a number with an optional unit K, M, G or T, eg: 16G. Got {}'.format(memory_str))
+    if memory<=0:
+        raise ValueError('Memory must be positive. Got {}'.format(memory_str))
+    return memory
+
+def call_regions_chunks_in_budget(bam_filename, out_dir, regions_chunks, chunk_reads, max_memory,
+    rand_str='', processes=None, max_depth=None, reference_filename=None, threads=1,
+    callback=None):
+    ''' Call regions chunks in worker processes within a memory budget.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM or CRAM filename.
+    out_dir : str
+        The ouput directory.
+    regions_chunks : List of lists
+        The regions lists from get_regions_chunks().
+    chunk_reads : List of float
+        The estimated read count of each regions chunk from estimate_regions_reads().
+    max_memory : int
+        The memory budget of this process and all workers in megabytes.
+    rand_str : str, optional
+        Add the rand_str in the prefix to tempfiles.
+    processes : int, optional
+        The maximum number of calling processes. Default is the number of CPUs.
+    max_depth : int, optional
+        The maximum read depth. See meth_call_by_region().
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+    callback : function, optional
+        Called with the estimated read count of every finished chunk.
+
+    Returns
+    -------
+    List of dict
+        The metrics records of all chunks.
+
+    Notes
+    -----
+    * Every process takes about the RSS of this process. The processes are
+    reduced until each of them has at least the same for its chunk.
+    * The memory of a chunk is its estimated reads times the memory per read,
+    which starts at DEFAULT_MEMORY_PER_READ_KB and then is the largest one of
+    the finished chunks that raised the peak RSS of their workers.
+    * A chunk that needs more than its process's share is split, and chunks are
+    only started while the estimated memory in use fits the budget.
+    * Workers write the calls of every region to disk before the next region.
+    * Split regions start a new depth count, so with max_depth a few more reads
+    may be kept at the split positions.
+    '''
+    from multiprocessing import Pool
+    import multiprocessing
+    import collections
+    import math
+    from mirror_seq import metrics as mt
+
+    base_kb = mt.get_peak_rss()
+    available_kb = max_memory * 1024 - base_kb
+    processes = processes or multiprocessing.cpu_count()
+    processes = max(1, min(processes, available_kb // (2 * base_kb)))
+    tasks_kb = available_kb - processes * base_kb
+    if tasks_kb<=0:
+        raise Exception('The memory budget {}M is less than the {}M needed by a calling process.'.format(
+            max_memory, (2 * base_kb) // 1024 + 1))
+    task_cap_kb = float(tasks_kb) / processes
+    print('Use {} processes and up to {}M per regions chunk to fit {}M of memory.'.format(
+        processes, int(task_cap_kb) // 1024, max_memory))
+
+    memory_per_read_samples = []
+    queue = collections.deque(zip(regions_chunks, chunk_reads))
+    pending_results = []
+    records = []
+
+    def get_memory_per_read():
+        if memory_per_read_samples:
+            return max(memory_per_read_samples)
+        return DEFAULT_MEMORY_PER_READ_KB
+
+    def collect_results():
+        for item in list(pending_results):
+            result, estimated_kb, reads = item
+            if not result.ready():
+                continue
+            pending_results.remove(item)
+            chunk_records = result.get()
+            records.extend(chunk_records)
+            # ru_maxrss only grows, so only the chunks raising it show their own peak.
+            chunk_record = chunk_records[-1]
+            if chunk_record['reads'] and \
+                chunk_record['peak_rss_kb']>chunk_record['start_peak_rss_kb']:
+                memory_per_read_samples.append(
+                    float(chunk_record['peak_rss_kb'] - base_kb) / chunk_record['reads'])
+            if callback:
+                callback(reads)
+
+    p = Pool(processes)
+    while queue or pending_results:
+        collect_results()
+        if queue:
+            regions, reads = queue[0]
+            estimated_kb = reads * get_memory_per_read()
+            total_nts = sum(end - start + 1 for _, start, end in regions)
+            if estimated_kb>task_cap_kb and total_nts>1:
+                queue.popleft()
+                sub_chunks = split_regions_chunk(regions,
+                    int(math.ceil(estimated_kb / task_cap_kb)))
+                for sub_regions in reversed(sub_chunks):
+                    sub_nts = sum(end - start + 1 for _, start, end in sub_regions)
+                    queue.appendleft((sub_regions, reads * float(sub_nts) / total_nts))
+                continue
+            in_use_kb = sum(item[1] for item in pending_results)
+            if not pending_results or (len(pending_results)<processes and
+                in_use_kb + estimated_kb<=tasks_kb):
+                queue.popleft()
+                pending_results.append((p.apply_async(
+                    write_meth_data_by_regions,
+                    (bam_filename, out_dir, regions, rand_str, max_depth, reference_filename,
+                        threads, True),
+                ), estimated_kb, reads))
+                continue
+        if pending_results:
+            pending_results[0][0].wait(0.1)
+    p.close()
+    p.join()
+    return records
+
+def parse_to_bed(data_filename, bed_filename, chunksize=1000000):
+    ''' Parse the standard output format to BED format.
+
+    Parameters
+    ----------
+    data_filename : str
+        The data filename.
+    bed_filename : str
+        The output BED filename.
+    chunksize : int, optional
+        The chunk size when reading files.
+
+    Returns
+    -------
+    dict
+        The metrics record of this step.
+    '''
+    import pandas as pd
+    import numpy as np
+    import subprocess
+    import os
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    sites = 0
+    with open(bed_filename, 'w') as fw:
+        for df in pd.read_csv(data_filename, chunksize=chunksize):
+            df['end'] = df['pos'] + 1
+            df['thick_start'] = 0
+            df['thick_end'] = 0
+            df['meth_ratio'] = df['meth_count'] / df['total_count']
+            df['score'] = (df['meth_ratio'] * 1000).round().astype(np.uint32)
+            # Vectorized '{0}/{1}({2:.0%})' and '255,{0:.0f},0'. Both round half to even.
+            df['name'] = (df['meth_count'].astype(str) + '/' + df['total_count'].astype(str)
+                + '(' + np.rint(df['meth_ratio'] * 100).astype(np.int64).astype(str) + '%)')
+            df['rgb'] = '255,' + np.rint(255 * df['meth_ratio']).astype(np.int64).astype(str) + ',0'
+
+            colnames = [
+                'chrom',
+                'pos',
+                'end',
+                'name',
+                'score',
+                'strand',
+                'thick_start',
+                'thick_end',
+                'rgb'
+            ]
+            df[colnames].to_csv(fw, sep='\t', index=False, header=False)
+            sites += len(df)
+    temp_folder = os.path.dirname(bed_filename)
+    subprocess.check_call((
+        "sort",
+        "-T", temp_folder,
+        "-k1,1",
+        "-k2,2n",
+        bed_filename,
+        "-o", bed_filename,
+    ))
+    subprocess.check_call(('gzip', '-f', bed_filename))
+
+    return mt.make_record(
+        'bed',
+        start_time,
+        name=bed_filename + '.gz',
+        sites=sites,
+        bytes_read=mt.get_file_size(data_filename),
+        bytes_written=mt.get_file_size(bed_filename + '.gz'),
+    )
+
+def parse_to_tracks(data_filename, track_prefix, chrom_sizes, create_bigwig=False,
+    chunksize=1000000):
+    ''' Parse the standard output format to hydroxymethylation ratio and coverage tracks.
+
+    Parameters
+    ----------
+    data_filename : str
+        The CpG data filename. It must be sorted by chrom, pos and strand.
+    track_prefix : str
+        The output prefix. The outputs are <track_prefix>_ratio.bedGraph.gz and
+        <track_prefix>_coverage.bedGraph.gz.
+    chrom_sizes : List of tuples
+        (chromosome, size) of all chromosomes.
+    create_bigwig : bool, optional
+        If True, also create <track_prefix>_ratio.bw and <track_prefix>_coverage.bw
+        with zoom levels by bedGraphToBigWig, which must be in PATH.
+    chunksize : int, optional
+        The chunk size when reading files.
+
+    Returns
+    -------
+    dict
+        The metrics record of this step.
+
+    Notes
+    -----
+    * The two strands of a CpG are added up at the position of its C on the
+    forward strand, because bedGraph intervals cannot overlap. After
+    mirror_seq_conversion(), they are (pos, '+') and (pos+1, '-').
+    * Only one chunk is in memory, so it works for any number of CpGs.
+    '''
+    import pandas as pd
+    import numpy as np
+    import subprocess
+    import os
+    import tempfile
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    ratio_filename = '{}_ratio.bedGraph'.format(track_prefix)
+    coverage_filename = '{}_coverage.bedGraph'.format(track_prefix)
+    sites = 0
+
+    def write_tracks(df, fw_ratio, fw_coverage):
+        df = df.groupby(['chrom', 'pos'], sort=False)[['meth_count', 'total_count']].sum()
+        df.reset_index(inplace=True)
+        # Shifting '-' may put a position before the one of the previous row.
+        df['chrom_order'] = pd.factorize(df['chrom'])[0]
+        df.sort_values(['chrom_order', 'pos'], inplace=True)
+        df['end'] = df['pos'] + 1
+        df['meth_ratio'] = (df['meth_count'] / df['total_count']).round(4)
+        df[['chrom', 'pos', 'end', 'meth_ratio']].to_csv(fw_ratio, sep='\t', index=False,
+            header=False)
+        df[['chrom', 'pos', 'end', 'total_count']].to_csv(fw_coverage, sep='\t', index=False,
+            header=False)
+        return len(df)
+
+    with open(ratio_filename, 'w') as fw_ratio, open(coverage_filename, 'w') as fw_coverage:
+        last_df = None
+        for df in pd.read_csv(data_filename, chunksize=chunksize):
+            df['pos'] -= (df['strand']=='-').astype(np.int64)
+            if last_df is not None:
+                df = pd.concat((last_df, df), ignore_index=True)
+            # Keep the last CpG for the next chunk, which may have its other strand.
+            is_last = (df['chrom']==df['chrom'].iat[-1]) & (df['pos']==df['pos'].iat[-1])
+            last_df = df[is_last]
+            if not is_last.all():
+                sites += write_tracks(df[~is_last], fw_ratio, fw_coverage)
+        if last_df is not None:
+            sites += write_tracks(last_df, fw_ratio, fw_coverage)
+
+    bytes_written = 0
+    if create_bigwig:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(track_prefix)),
+            suffix='.chrom.sizes', delete=False) as fw:
+            for chrom, size in chrom_sizes:
+                fw.write('{}\t{}\n'.format(chrom, size))
+        try:
+            for bedgraph_filename in (ratio_filename, coverage_filename):
+                bigwig_filename = bedgraph_filename.replace('.bedGraph', '.bw')
+                subprocess.check_call(('bedGraphToBigWig', bedgraph_filename, fw.name,
+                    bigwig_filename))
+                bytes_written += mt.get_file_size(bigwig_filename)
+        finally:
+            os.remove(fw.name)
+
+    for bedgraph_filename in (ratio_filename, coverage_filename):
+        subprocess.check_call(('gzip', '-f', bedgraph_filename))
+        bytes_written += mt.get_file_size(bedgraph_filename + '.gz')
+
+    return mt.make_record(
+        'tracks',
+        start_time,
+        name=track_prefix,
+        sites=sites,
+        bytes_read=mt.get_file_size(data_filename),
+        bytes_written=bytes_written,
+    )
+
+def mirror_seq_conversion(df):
+    ''' Convert methylation ratios and strands.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        with columns - strand, pos, meth_count, and total_count.
+    '''
+    import pandas as pd
+
+    pos_series = pd.concat((
+        df[df['strand']=='+']['pos'] + 1,
+        df[df['strand']=='-']['pos'] - 1,
+    ))
+    df['pos'] = pos_series
+    df['strand'] = df['strand'].replace({'+': '--', '-': '++'}).replace({'--': '-', '++': '+'})
+    df['meth_count'] = df['total_count'] - df['meth_count']
+
+def iter_table_rows(filename):
+    ''' Iterate the rows of a gzipped output table.
+
+    Parameters
+    ----------
+    filename : str
+        The gzipped csv filename with columns chrom, pos, strand, meth_count and
+        total_count.
+
+    Yields
+    ------
+    str
+        chromosome
+    int
+        position
+    str
+        strand
+    str
+        The raw csv line.
+
+    Raises
+    ------
+    Exception
+        If the rows are not sorted by chrom, pos and strand.
+    '''
+    import gzip
+    import io
+
+    last_key = None
+    with io.BufferedReader(gzip.open(filename)) as f:
+        # Skip the header.
+        f.readline()
+        for line in f:
+            chrom, pos, strand, _ = line.split(',', 3)
+            key = (chrom, int(pos), strand)
+            if key<last_key:
+                raise Exception('{} is not sorted by chrom, pos and strand at {}:{}{}.'.format(
+                    filename, *key))
+            last_key = key
+            yield chrom, key[1], strand, line
+
+def sum_sorted_rows(rows):
+    ''' Sum the counts of consecutive rows at the same site.
+
+    Parameters
+    ----------
+    rows : iterable
+        Rows from iter_table_rows(), sorted by chrom, pos and strand.
+
+    Yields
+    ------
+    str
+        The csv line with summed meth_count and total_count.
+    '''
+    last_key = None
+    meth_count = total_count = 0
+    for chrom, pos, strand, line in rows:
+        key = (chrom, pos, strand)
+        if key!=last_key:
+            if last_key is not None:
+                yield '{},{},{},{},{}\n'.format(last_key[0], last_key[1], last_key[2],
+                    meth_count, total_count)
+            last_key = key
+            meth_count = total_count = 0
+        counts = line.rsplit(',', 2)
+        meth_count += int(counts[1])
+        total_count += int(counts[2])
+    if last_key is not None:
+        yield '{},{},{},{},{}\n'.format(last_key[0], last_key[1], last_key[2],
+            meth_count, total_count)
+
+def merge_sorted_tables(filenames, out_filename, sum_counts=False):
+    ''' Merge sorted output tables into one sorted table in a single streaming pass.
+
+    Parameters
+    ----------
+    filenames : List of str
+        The gzipped csv filenames. Each one is sorted by chrom, pos and strand.
+    out_filename : str
+        The output csv filename. It is not gzipped.
+    sum_counts : bool, optional
+        If True, write one row per site with the counts summed over all tables.
+        Otherwise, the tables must not share any sites.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+    '''
+    import heapq
+
+    rows = heapq.merge(*[iter_table_rows(f) for f in filenames])
+    if sum_counts:
+        lines = sum_sorted_rows(rows)
+    else:
+        lines = (line for _, _, _, line in rows)
+
+    row_count = 0
+    with open(out_filename, 'w') as fw:
+        fw.write(','.join(TABLE_COLUMNS) + '\n')
+        for line in lines:
+            fw.write(line)
+            row_count += 1
+    return row_count
+
+def merge_n_parse(out_prefix, meth_type, filenames, create_bed_file, sum_counts=False):
+    ''' The is a shortcut function, which is easier to be used by multiprocessing.
+
+    Parameters
+    ----------
+    out_prefix : str
+        The output prefix.
+    meth_type : str
+        The methylation type. Eg: CpG, CHG, and CHH.
+    filenames : str
+        The csv filenames to be mreged.
+    create_bed_file : bool
+        Create a bed file or not.
+    sum_counts : bool, optional
+        Sum the counts of the same site in different files.
+
+    Returns
+    -------
+    List of dict
+        The metrics records of merging and BED generation.
+    '''
+    import pandas as pd
+    import os
+    import subprocess
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    full_filename = '{0}_{1}.csv'.format(out_prefix, meth_type)
+    sites = merge_sorted_tables(filenames, full_filename, sum_counts)
     subprocess.check_call(('gzip', '-f', full_filename))
     full_filename += '.gz'
 
+    records = [mt.make_record(
+        'merge',
+        start_time,
+        name=full_filename,
+        sites=sites,
+        bytes_read=sum(mt.get_file_size(filename) for filename in filenames),
+        bytes_written=mt.get_file_size(full_filename),
+    )]
+
     if meth_type=='CpG' and create_bed_file:
         bed_filename = full_filename.replace('.csv.gz', '.bed')
-        parse_to_bed(full_filename, bed_filename)
+        records.append(parse_to_bed(full_filename, bed_filename))
+    return records
 
-def get_bs_conv_rate(filenames):
-    '''Calculate the bisulfite conversion rate using CHH and CHG methylation tracks.
+def get_meth_ratio_sum(filenames):
+    ''' Sum the methylation ratios of all sites in methylation tracks.
 
     Parameters
     ----------
     filenames : List of str
-        the filenames of non-CpGs.
+        the filenames of non-CpGs. Missing files are skipped.
 
     Returns
     -------
     float
-        The estimated bisulfite conversion rate.
-
-    NOTES
-    -----
-    1. Get conversion rate for each non CpGs and average them.
-    2. The esitmated bisulfite conversion rate is rounded to 2 decimal.
-    3. Return None if no sites in all files.
-
+        The sum of methylation ratios.
+    int
+        The number of sites.
     '''
     import pandas as pd
     import os
@@ -346,6 +1670,36 @@ def get_bs_conv_rate(filenames):
                 meth_ratio_sum += (df['meth_count'] / df['total_count']).sum()
                 count += len(df)
 
+    return meth_ratio_sum, count
+
+def get_bs_conv_rate(filenames, meth_ratio_sum=0, count=0):
+    '''Calculate the bisulfite conversion rate using CHH and CHG methylation tracks.
+
+    Parameters
+    ----------
+    filenames : List of str
+        the filenames of non-CpGs.
+    meth_ratio_sum : float, optional
+        The methylation ratio sum of sites which are not in the files. Eg: from shards.
+    count : int, optional
+        The number of sites which are not in the files.
+
+    Returns
+    -------
+    float
+        The estimated bisulfite conversion rate.
+
+    NOTES
+    -----
+    1. Get conversion rate for each non CpGs and average them.
+    2. The esitmated bisulfite conversion rate is rounded to 2 decimal.
+    3. Return None if no sites in all files.
+
+    '''
+    file_meth_ratio_sum, file_count = get_meth_ratio_sum(filenames)
+    meth_ratio_sum += file_meth_ratio_sum
+    count += file_count
+
     try:
         bs_conv_rate = 1 - round(meth_ratio_sum / count, 2)
     except ZeroDivisionError:
@@ -353,14 +1707,567 @@ def get_bs_conv_rate(filenames):
 
     return bs_conv_rate
 
+def print_bs_conv_rate(conversion_rate):
+    ''' Print the bisulfite conversion rate.
+
+    Parameters
+    ----------
+    conversion_rate : float
+        The rate from get_bs_conv_rate(). None if it cannot be estimated.
+    '''
+    if conversion_rate is not None:
+        print('Bisuflite conversion rate: {:.0%}'.format(conversion_rate))
+    else:
+        print('Cannot estimate bisuflite conversion rate.')
+
+def get_estimate_windows(bam_filename, window_count=500, window_size=1000, seed=0,
+    include_contigs=None, exclude_contigs=None):
+    ''' Draw a stratified sample of windows across chromosomes.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM or CRAM filename.
+    window_count : int, optional
+        Number of windows.
+    window_size : int, optional
+        Number of nucleotides in a window.
+    seed : int, optional
+        The random seed. The same seed gives the same windows.
+    include_contigs : List of str, optional
+        See filter_chroms().
+    exclude_contigs : List of str, optional
+        See filter_chroms().
+
+    Returns
+    -------
+    List of tuples
+        (chromosome, start, end, weight). The end is included. weight is the
+        inverse of the sampling density, to weight the window in estimates.
+
+    Notes
+    -----
+    * The chromosomes are lined up and cut into window_count equal strata by
+    their mapped reads in the BAM index, or by their sizes if the index has no
+    read counts, eg: CRAM. One window is put at a random position in every
+    stratum, so chromosomes with more reads get more windows.
+    '''
+    import bisect
+    import random
+
+    with open_alignment_file(bam_filename) as samfile:
+        chrom_sizes = [(d['SN'], d['LN']) for d in samfile.header['SQ']]
+        try:
+            chrom_reads = {stat.contig: stat.mapped for stat in samfile.get_index_statistics()}
+        except (AttributeError, ValueError):
+            chrom_reads = {}
+    if not any(chrom_reads.itervalues()):
+        chrom_reads = {chrom: size for chrom, size in chrom_sizes}
+    chroms = set(filter_chroms([chrom for chrom, _ in chrom_sizes], include_contigs,
+        exclude_contigs))
+    chrom_sizes = [(chrom, size) for chrom, size in chrom_sizes
+        if chrom in chroms and chrom_reads.get(chrom, 0)>0]
+    if not chrom_sizes:
+        return []
+
+    cumulative_reads = []
+    total_reads = 0
+    for chrom, _ in chrom_sizes:
+        total_reads += chrom_reads[chrom]
+        cumulative_reads.append(total_reads)
+
+    rand = random.Random(seed)
+    windows = []
+    for i in range(window_count):
+        u = (i + rand.random()) / window_count * total_reads
+        chrom_idx = min(bisect.bisect_right(cumulative_reads, u), len(chrom_sizes) - 1)
+        chrom, size = chrom_sizes[chrom_idx]
+        reads = chrom_reads[chrom]
+        offset = (u - (cumulative_reads[chrom_idx] - reads)) / reads
+        start = int(offset * size) - window_size // 2
+        start = max(0, min(start, size - window_size))
+        end = min(start + window_size, size) - 1
+        windows.append((chrom, start, end, float(size) / reads))
+    return windows
+
+def get_ratio_interval(numerators, denominators, weights=None, z=1.96):
+    ''' Estimate a ratio and its confidence interval from sampled windows.
+
+    Parameters
+    ----------
+    numerators : List of float
+        The numerator of every window.
+    denominators : List of float
+        The denominator of every window.
+    weights : List of float, optional
+        The weight of every window. Default is 1 for all.
+    z : float, optional
+        The normal quantile of the interval. 1.96 gives 95%.
+
+    Returns
+    -------
+    tuple
+        (ratio, low, high). All None if the denominators add up to 0.
+
+    Notes
+    -----
+    * The variance is from the linearization of the ratio estimator, taking the
+    windows as independent draws.
+    '''
+    import numpy as np
+
+    y = np.asarray(numerators, dtype=float)
+    x = np.asarray(denominators, dtype=float)
+    w = np.ones(len(x)) if weights is None else np.asarray(weights, dtype=float)
+    total_x = (w * x).sum()
+    if total_x<=0:
+        return None, None, None
+    ratio = (w * y).sum() / total_x
+    n = len(x)
+    if n<2:
+        return ratio, None, None
+    residuals = w * (y - ratio * x)
+    se = np.sqrt(n / (n - 1.0) * (residuals ** 2).sum()) / total_x
+    return ratio, ratio - z * se, ratio + z * se
+
+def get_read_name_hash(query_name):
+    ''' Hash a read name to subsample reads.
+
+    Parameters
+    ----------
+    query_name : str
+        The read name.
+
+    Returns
+    -------
+    int
+        A hash from 0 to 2**32-1. It is the same in every run and for both mates.
+    '''
+    import zlib
+
+    return zlib.crc32(query_name) & 0xffffffff
+
+def get_window_read_threshold(expected_reads, max_reads):
+    ''' Get the read name hash threshold which subsamples a window to about max_reads.
+
+    Parameters
+    ----------
+    expected_reads : float
+        The expected number of reads in the window, from the read density in the
+        BAM index. None if it is unknown, eg: CRAM.
+    max_reads : int
+        The maximum number of reads kept.
+
+    Returns
+    -------
+    int
+        Keep the reads whose get_read_name_hash() is not above it, or None to keep
+        all reads.
+
+    Notes
+    -----
+    * Reads are kept by the hash of their names instead of their positions, so
+    the kept reads spread evenly across the window and both mates of a pair are
+    kept together.
+    * The threshold is known before the window is fetched, so the reads are
+    filtered in one pass and the time spent on a deep window does not grow with
+    its depth.
+    '''
+    if not expected_reads or expected_reads<=max_reads:
+        return None
+    return int(float(max_reads) / expected_reads * 2**32)
+
+def estimate_meth(bam_filename, window_count=500, window_size=1000, max_reads_per_window=200,
+    seed=0, reference_filename=None, threads=1, include_contigs=None, exclude_contigs=None):
+    ''' Estimate the CpG hydroxymethylation level, CpG coverage and bisulfite
+    conversion rate from a sample of windows.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The sorted and indexed alignment BAM or CRAM filename.
+    window_count : int, optional
+        Number of windows. See get_estimate_windows().
+    window_size : int, optional
+        Number of nucleotides in a window.
+    max_reads_per_window : int, optional
+        Deeper windows, eg: chrM, are subsampled to about this many reads, so they
+        do not dominate the runtime. See get_window_read_threshold().
+    seed : int, optional
+        The random seed of the windows.
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    threads : int, optional
+        Number of htslib threads to decompress the file.
+    include_contigs : List of str, optional
+        See filter_chroms().
+    exclude_contigs : List of str, optional
+        See filter_chroms().
+
+    Returns
+    -------
+    dict
+        "hmc_level", "cpg_coverage" and "bs_conv_rate" are (estimate, low, high)
+        tuples of 95% confidence intervals. Also "windows" and "reads".
+
+    Notes
+    -----
+    * hmc_level is the ratio of hydroxymethylated CpG calls, the same as the
+    CpG output after the Mirror-seq conversion.
+    * cpg_coverage is the mean number of calls of the covered CpG sites.
+    * bs_conv_rate averages the non-CpG sites like get_bs_conv_rate().
+    * The calls of a subsampled window are scaled up by its reads over the
+    kept reads, so the window keeps its weight in hmc_level and cpg_coverage.
+    * Windows are only subsampled with the read counts in the BAM index.
+    '''
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    windows = get_estimate_windows(bam_filename, window_count, window_size, seed,
+        include_contigs, exclude_contigs)
+    hmc_calls = []
+    cpg_calls = []
+    cpg_sites = []
+    non_cpg_ratio_sums = []
+    non_cpg_sites = []
+    read_count = 0
+    with open_alignment_file(bam_filename, reference_filename, threads) as samfile:
+        chrom_sizes = {d['SN']: d['LN'] for d in samfile.header['SQ']}
+        try:
+            chrom_reads = {stat.contig: stat.mapped for stat in samfile.get_index_statistics()}
+        except (AttributeError, ValueError):
+            chrom_reads = {}
+        for chrom, start, end, _ in windows:
+            expected_reads = None
+            if chrom_reads.get(chrom):
+                expected_reads = float(chrom_reads[chrom]) / chrom_sizes[chrom] * (end - start + 1)
+            threshold = get_window_read_threshold(expected_reads, max_reads_per_window)
+            # Values are lists of meth_count and total_count.
+            site_calls_d = {}
+            window_reads = 0
+            window_total_reads = 0
+            for read in samfile.fetch(chrom, start, end + 1):
+                window_total_reads += 1
+                if threshold is not None and get_read_name_hash(read.query_name)>threshold:
+                    continue
+                window_reads += 1
+                for _, pos, strand, meth_code in meth_call_for_read(read):
+                    if not start<=pos<=end:
+                        continue
+                    meth_calls = site_calls_d.setdefault((pos, strand, meth_code.upper()), [0, 0])
+                    if meth_code.isupper():
+                        meth_calls[0] += 1
+                    meth_calls[1] += 1
+            read_count += window_reads
+
+            window_hmc_calls = window_cpg_calls = window_cpg_sites = 0
+            window_ratio_sum = 0.0
+            window_non_cpg_sites = 0
+            for (_, _, meth_code), (meth_count, total_count) in site_calls_d.iteritems():
+                if meth_code=='Z':
+                    # Unmethylated CpG calls are hydroxymethylated after the conversion.
+                    window_hmc_calls += total_count - meth_count
+                    window_cpg_calls += total_count
+                    window_cpg_sites += 1
+                else:
+                    window_ratio_sum += float(meth_count) / total_count
+                    window_non_cpg_sites += 1
+            scale = float(window_total_reads) / window_reads if window_reads else 1.0
+            hmc_calls.append(window_hmc_calls * scale)
+            cpg_calls.append(window_cpg_calls * scale)
+            cpg_sites.append(window_cpg_sites)
+            non_cpg_ratio_sums.append(window_ratio_sum)
+            non_cpg_sites.append(window_non_cpg_sites)
+
+    weights = [weight for _, _, _, weight in windows]
+    non_cpg_meth = get_ratio_interval(non_cpg_ratio_sums, non_cpg_sites, weights)
+    bs_conv_rate = (None, None, None)
+    if non_cpg_meth[0] is not None:
+        bs_conv_rate = tuple(None if v is None else 1 - v for v in
+            (non_cpg_meth[0], non_cpg_meth[2], non_cpg_meth[1]))
+    estimates = {
+        'windows': len(windows),
+        'reads': read_count,
+        'hmc_level': get_ratio_interval(hmc_calls, cpg_calls, weights),
+        'cpg_coverage': get_ratio_interval(cpg_calls, cpg_sites, weights),
+        'bs_conv_rate': bs_conv_rate,
+    }
+    estimates['record'] = mt.make_record(
+        'estimate',
+        start_time,
+        name=bam_filename,
+        reads=read_count,
+        sites=sum(cpg_sites) + sum(non_cpg_sites),
+    )
+    return estimates
+
+def print_estimates(estimates):
+    ''' Print the estimates from estimate_meth().
+
+    Parameters
+    ----------
+    estimates : dict
+        The estimates from estimate_meth().
+    '''
+    def format_interval(interval, value_format):
+        value, low, high = interval
+        if value is None:
+            return 'cannot be estimated'
+        if low is None:
+            return value_format.format(value)
+        return '{} (95% CI {} - {})'.format(value_format.format(value),
+            value_format.format(low), value_format.format(high))
+
+    print('Estimated from {} reads in {} windows:'.format(estimates['reads'],
+        estimates['windows']))
+    print('CpG hydroxymethylation level: {}'.format(
+        format_interval(estimates['hmc_level'], '{:.1%}')))
+    print('CpG coverage: {}'.format(format_interval(estimates['cpg_coverage'], '{:.1f}')))
+    print('Bisuflite conversion rate: {}'.format(
+        format_interval(estimates['bs_conv_rate'], '{:.1%}')))
+
+def parse_shard(shard_str):
+    ''' Parse a shard string.
+
+    Parameters
+    ----------
+    shard_str : str
+        Formatted as "<INDEX>/<COUNT>", where INDEX starts from 1. Eg: 3/10.
+
+    Returns
+    -------
+    tuple
+        (index, count)
+    '''
+    try:
+        shard_index, shard_count = [int(s) for s in shard_str.split('/')]
+    except ValueError:
+        raise ValueError('Shard must be formatted as <INDEX>/<COUNT>, eg: 3/10. Got {}'.format(shard_str))
+    if not 1<=shard_index<=shard_count:
+        raise ValueError('Shard index must be between 1 and {}. Got {}'.format(shard_count, shard_index))
+    return shard_index, shard_count
+
+def get_shard_regions_chunks(bam_filename, shard_index, shard_count, nts_in_regions=100000000,
+    targets=None, include_contigs=None, exclude_contigs=None):
+    ''' Get the regions chunks of one shard.
+
+    Parameters
+    ----------
+    bam_filename : str
+        The alignment BAM filename.
+    shard_index : int
+        The shard index, starting from 1.
+    shard_count : int
+        Total number of shards.
+    nts_in_regions : int, optional
+        Number of total nucleotides in an iter of regions. Smaller number gives
+        better balanced shards.
+    targets : dict, optional
+        The targets from read_targets(). See get_regions_chunks().
+    include_contigs : List of str, optional
+        See get_regions_chunks().
+    exclude_contigs : List of str, optional
+        See get_regions_chunks().
+
+    Returns
+    -------
+    List
+        The regions chunks from get_regions_chunks() assigned to this shard.
+
+    Notes
+    -----
+    * Chunks are assigned to shards by greedily giving the chunk with the most
+    estimated reads to the shard with the least reads. It only depends on the BAM
+    header and index so every shard gets the same assignment.
+    '''
+    regions_chunks = list(get_regions_chunks(bam_filename, nts_in_regions, targets,
+        include_contigs, exclude_contigs))
+    chunk_reads = estimate_regions_reads(bam_filename, regions_chunks)
+
+    shard_reads = [0] * shard_count
+    chunk_shards = [None] * len(regions_chunks)
+    for chunk_idx in sorted(range(len(regions_chunks)), key=lambda i: (-chunk_reads[i], i)):
+        shard = min(range(shard_count), key=lambda i: (shard_reads[i], i))
+        shard_reads[shard] += chunk_reads[chunk_idx]
+        chunk_shards[chunk_idx] = shard + 1
+
+    return [regions for regions, shard in zip(regions_chunks, chunk_shards) if shard==shard_index]
 
-def main(bam_filename, out_prefix, create_bed_file, nts_in_regions=100000000):
+def get_shard_prefix(out_prefix, shard_index, shard_count):
+    ''' Get the output prefix of a shard.
+
+    Parameters
+    ----------
+    out_prefix : str
+        The output file prefix.
+    shard_index : int
+        The shard index, starting from 1.
+    shard_count : int
+        Total number of shards.
+
+    Returns
+    -------
+    str
+        <out_prefix>_shard<INDEX>of<COUNT>
+    '''
+    return '{}_shard{}of{}'.format(out_prefix, shard_index, shard_count)
+
+def merge_shards(manifest_filenames, out_prefix, create_bed_file, metrics_filename=None,
+    create_bedgraph=False, create_bigwig=False):
+    ''' Merge the partial outputs of all shards into the final outputs.
+
+    Parameters
+    ----------
+    manifest_filenames : List of str
+        The shard manifest filenames (<SHARD_PREFIX>.json) written by main().
+    out_prefix : str
+        The output file prefix.
+    create_bed_file : bool
+        Create a bed file or not.
+    metrics_filename : str, optional
+        If given, write the performance metrics into this file.
+    create_bedgraph : bool, optional
+        Create hydroxymethylation ratio and coverage bedGraph files or not.
+        See parse_to_tracks().
+    create_bigwig : bool, optional
+        Create hydroxymethylation ratio and coverage bigWig files or not. The
+        chromosome sizes are from the manifests.
+    '''
+    import json
+    import os
+    import subprocess
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    manifests = []
+    for manifest_filename in manifest_filenames:
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        manifest['dir'] = os.path.dirname(manifest_filename)
+        manifests.append(manifest)
+
+    if not manifests:
+        raise Exception('No shard manifests to merge.')
+    shard_count = manifests[0]['shard_count']
+    # Nodes may stage or mount the input files at different paths, so the BAM file
+    # is checked by its size and chromosomes, and the targets by their basename.
+    # The paths are only for information.
+    def get_targets_basename(manifest):
+        targets_filename = manifest.get('targets_filename')
+        return targets_filename and os.path.basename(targets_filename)
+
+    for manifest in manifests:
+        for key in ('bam_size', 'chrom_sizes'):
+            if manifest.get(key)!=manifests[0].get(key):
+                raise Exception('Shards have different BAM files: {} and {} ({})'.format(
+                    manifests[0]['bam_filename'], manifest['bam_filename'], key))
+        for key in ('shard_count', 'nts_in_regions', 'max_depth', 'target_padding',
+            'include_contigs', 'exclude_contigs'):
+            if manifest.get(key)!=manifests[0].get(key):
+                raise Exception('Shards have different {}: {} and {}'.format(
+                    key, manifests[0].get(key), manifest.get(key)))
+        if get_targets_basename(manifest)!=get_targets_basename(manifests[0]):
+            raise Exception('Shards have different targets: {} and {}'.format(
+                manifests[0].get('targets_filename'), manifest.get('targets_filename')))
+    shard_indexes = sorted(manifest['shard_index'] for manifest in manifests)
+    if shard_indexes!=range(1, shard_count+1):
+        missing = sorted(set(range(1, shard_count+1)) - set(shard_indexes))
+        raise Exception('Need each of the {} shards exactly once. Missing: {}. Got: {}'.format(
+            shard_count, missing, shard_indexes))
+
+    print('Merge {} shards...'.format(shard_count))
+    records = []
+    meth_type = 'CpG'
+    filenames = [os.path.join(m['dir'], m['tables'][meth_type]) for m in manifests
+        if meth_type in m['tables']]
+    records += merge_n_parse(out_prefix, meth_type, filenames, create_bed_file)
+    if create_bedgraph or create_bigwig:
+        chrom_sizes = manifests[0].get('chrom_sizes')
+        if chrom_sizes is None:
+            # Manifests of older versions do not have the chromosome sizes.
+            chrom_sizes = get_chrom_sizes(manifests[0]['bam_filename'])
+        records.append(parse_to_tracks('{}_{}.csv.gz'.format(out_prefix, meth_type),
+            '{}_{}'.format(out_prefix, meth_type), chrom_sizes, create_bigwig))
+
+    conversion_rate = get_bs_conv_rate(
+        [],
+        sum(m['non_cpg_meth_ratio_sum'] for m in manifests),
+        sum(m['non_cpg_site_count'] for m in manifests),
+    )
+    print_bs_conv_rate(conversion_rate)
+
+    records.append(mt.make_record('total', start_time, name=out_prefix))
+    if metrics_filename:
+        mt.write_metrics(records, metrics_filename)
+        print('Metrics are written to {}'.format(metrics_filename))
+    print('Done!')
+
+def merge_count_tables(filenames, out_prefix, create_bed_file, metrics_filename=None,
+    create_bedgraph=False, create_bigwig=False, chrom_sizes=None):
+    ''' Add up the CpG tables of the same sample from different lanes or runs.
+
+    Parameters
+    ----------
+    filenames : List of str
+        The <PREFIX>_CpG.csv.gz files from main(). They must be sorted by chrom, pos
+        and strand, which main() does.
+    out_prefix : str
+        The output file prefix. The output file is <out_prefix>_CpG.csv.gz.
+    create_bed_file : bool
+        Create a bed file or not.
+    metrics_filename : str, optional
+        If given, write the performance metrics into this file.
+    create_bedgraph : bool, optional
+        Create hydroxymethylation ratio and coverage bedGraph files or not.
+        See parse_to_tracks().
+    create_bigwig : bool, optional
+        Create hydroxymethylation ratio and coverage bigWig files or not.
+    chrom_sizes : List of tuples, optional
+        (chromosome, size) of all chromosomes. Required by create_bigwig, as the
+        CpG tables do not have them. See read_chrom_sizes().
+
+    Notes
+    -----
+    * meth_count and total_count are additive so the result is the same as calling
+    the merged BAM files. Only one row per file is kept in memory.
+    '''
+    import os
+    import time
+    from mirror_seq import metrics as mt
+
+    start_time = time.time()
+    out_filename = os.path.abspath('{}_CpG.csv.gz'.format(out_prefix))
+    if out_filename in [os.path.abspath(filename) for filename in filenames]:
+        raise Exception('The output file {} is one of the input files.'.format(out_filename))
+    if create_bigwig and not chrom_sizes:
+        raise Exception('bigWig files need the chromosome sizes.')
+
+    print('Merge {} files...'.format(len(filenames)))
+    records = merge_n_parse(out_prefix, 'CpG', filenames, create_bed_file, sum_counts=True)
+    if create_bedgraph or create_bigwig:
+        records.append(parse_to_tracks(out_filename, '{}_CpG'.format(out_prefix),
+            chrom_sizes, create_bigwig))
+    records.append(mt.make_record('total', start_time, name=out_prefix))
+    if metrics_filename:
+        mt.write_metrics(records, metrics_filename)
+        print('Metrics are written to {}'.format(metrics_filename))
+    print('Done!')
+
+def main(bam_filename, out_prefix, create_bed_file, nts_in_regions=100000000,
+    metrics_filename=None, progress=False, shard=None, max_depth=None,
+    reference_filename=None, ref_cache_dir=None, processes=None, threads=None,
+    unsorted=False, create_bedgraph=False, create_bigwig=False, max_memory=None,
+    targets_filename=None, target_padding=0, include_contigs=None, exclude_contigs=None,
+    estimate=False):
     ''' Run the entire methylation calling.
 
     Parameters
     ----------
     bam_filename : str
-        The alignment bam filename. The index file (.bai) must exist in the same folder.
+        The alignment bam or cram filename. The index file (.bai or .crai) must
+        exist in the same folder unless unsorted is True.
     out_prefix : str
         The output file prefix. The output file is <out_prefix>_<METH_TYPE>.h5.
     create_bed_file : bool
@@ -368,27 +2275,189 @@ def main(bam_filename, out_prefix, create_bed_file, nts_in_regions=100000000):
     nts_in_regions : int, optional
         Number of total nucleotides in an iter of regions. It is an rough number
         so it is possible to get more than the number.
+    metrics_filename : str, optional
+        If given, write the performance metrics of all stages and regions into
+        this file. JSON if it ends with ".json", otherwise TSV.
+    progress : bool, optional
+        If True, print the progress and ETA every time a regions chunk is done.
+    shard : tuple, optional
+        (index, count). If given, only call the regions of this shard and write
+        <out_prefix>_shard<INDEX>of<COUNT>_CpG.csv.gz and a manifest
+        <out_prefix>_shard<INDEX>of<COUNT>.json. Use merge_shards() to get the
+        final outputs, including the BED and track files.
+    max_depth : int, optional
+        If given, skip the reads starting at a position already covered by
+        max_depth reads. It bounds the time spent in repeats and artefact hotspots.
+    reference_filename : str, optional
+        The reference FASTA filename to decode CRAM.
+    ref_cache_dir : str, optional
+        The reference cache folder shared by workers and runs. If
+        reference_filename is also given, its sequences are added to the cache.
+    processes : int, optional
+        Number of calling processes. Default is the thread budget.
+    threads : int, optional
+        The total thread budget. The threads left by the processes are used to
+        decompress the alignment file. Default is the number of CPUs.
+    unsorted : bool, optional
+        If True, stream the alignment file once in any order, eg: Bismark output,
+        instead of fetching sorted regions. See stream_meth_call(). It cannot be
+        used with shard, max_depth, max_memory, targets_filename or estimate.
+    create_bedgraph : bool, optional
+        Create hydroxymethylation ratio and coverage bedGraph files or not.
+        See parse_to_tracks(). With shard, merge_shards() creates them instead.
+    create_bigwig : bool, optional
+        Create hydroxymethylation ratio and coverage bigWig files or not. It
+        needs bedGraphToBigWig in PATH.
+    max_memory : int, optional
+        The memory budget in megabytes. If given, the regions chunks are split,
+        and the processes and the chunks in flight are limited to fit it. See
+        call_regions_chunks_in_budget(). It cannot be used with unsorted.
+    targets_filename : str, optional
+        A BED file of target regions. If given, only call the targets. It
+        cannot be used with unsorted.
+    target_padding : int, optional
+        Number of nucleotides added to both sides of every target.
+    include_contigs : List of str, optional
+        Only call the chromosomes matching these shell-style patterns, eg: chr*.
+    exclude_contigs : List of str, optional
+        Do not call the chromosomes matching these shell-style patterns, eg: *_alt.
+    estimate : bool, optional
+        If True, only print the estimates from a sample of windows instead of
+        calling. See estimate_meth(). It cannot be used with shard,
+        targets_filename, target_padding, max_depth, max_memory or the output
+        files.
 
     '''
     from multiprocessing import Pool
     import multiprocessing
     import subprocess
     import pysam
-    import os, string, random
+    import os, string, random, time, json
     import pandas as pd
+    from mirror_seq import metrics as mt
+    from mirror_seq import __version__
+
+    if unsorted and (estimate or shard or max_depth or max_memory or targets_filename):
+        raise ValueError('Estimates, shards, the maximum depth, the memory budget and targets need a sorted and indexed alignment file.')
+    if estimate and (shard or targets_filename or target_padding or max_depth or max_memory
+        or create_bed_file or create_bedgraph or create_bigwig):
+        raise ValueError('Estimates sample windows of the whole genome and write no files, so they cannot be used with shards, targets, the maximum depth, the memory budget or output files.')
 
     print('Wokring on hydroxymethylation calling...')
+    start_time = time.time()
     out_dir = os.path.dirname(out_prefix)
     rand_str = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(8))
 
-    p = Pool()
-    for regions in get_regions_chunks(bam_filename, nts_in_regions):
-        p.apply_async(
-            write_meth_data_by_regions,
-            (bam_filename, out_dir, regions, rand_str),
-        )
-    p.close()
-    p.join()
+    processes, worker_threads = get_worker_threads(processes, threads)
+    print('Use {} processes with {} decompression threads each.'.format(processes,
+        worker_threads))
+    worker_reference_filename = reference_filename
+    if ref_cache_dir:
+        use_ref_cache(ref_cache_dir)
+        if reference_filename:
+            added = populate_ref_cache(reference_filename, ref_cache_dir)
+            print('{} reference sequences are added to {}'.format(added, ref_cache_dir))
+        with open_alignment_file(bam_filename) as samfile:
+            has_md5 = all('M5' in d for d in samfile.header['SQ'])
+        # Workers find the sequences in the cache by the MD5 checksums in the header.
+        if has_md5:
+            worker_reference_filename = None
+
+    if estimate:
+        estimates = estimate_meth(bam_filename, reference_filename=worker_reference_filename,
+            threads=worker_threads, include_contigs=include_contigs,
+            exclude_contigs=exclude_contigs)
+        print_estimates(estimates)
+        records = [estimates['record'], mt.make_record('total', start_time, name=out_prefix)]
+        if metrics_filename:
+            mt.write_metrics(records, metrics_filename)
+            print('Metrics are written to {}'.format(metrics_filename))
+        return estimates
+
+    if unsorted:
+        cpg_filename = '{}_CpG.csv'.format(out_prefix)
+        meth_ratio_sum, count, records = stream_meth_call(bam_filename, out_dir, rand_str,
+            cpg_filename, processes, worker_threads, worker_reference_filename,
+            progress=progress, include_contigs=include_contigs,
+            exclude_contigs=exclude_contigs)
+        subprocess.check_call(('gzip', '-f', cpg_filename))
+        cpg_filename += '.gz'
+        if create_bed_file:
+            records.append(parse_to_bed(cpg_filename, cpg_filename.replace('.csv.gz', '.bed')))
+        if create_bedgraph or create_bigwig:
+            records.append(parse_to_tracks(cpg_filename, '{}_CpG'.format(out_prefix),
+                get_chrom_sizes(bam_filename), create_bigwig))
+        print_bs_conv_rate(get_bs_conv_rate([], meth_ratio_sum, count))
+
+        records.append(mt.make_record('total', start_time, name=out_prefix))
+        if metrics_filename:
+            mt.write_metrics(records, metrics_filename)
+            print('Metrics are written to {}'.format(metrics_filename))
+        print('Done!')
+        return
+
+    targets = None
+    if targets_filename:
+        targets = read_targets(targets_filename, target_padding)
+        print('{} nucleotides in {} targets with padding {}'.format(
+            sum(end - start for chrom_targets in targets.itervalues()
+                for start, end in chrom_targets),
+            sum(len(chrom_targets) for chrom_targets in targets.itervalues()),
+            target_padding))
+    if shard:
+        shard_index, shard_count = shard
+        regions_chunks = get_shard_regions_chunks(bam_filename, shard_index, shard_count,
+            nts_in_regions, targets, include_contigs, exclude_contigs)
+        table_prefix = get_shard_prefix(out_prefix, shard_index, shard_count)
+        print('Shard {}/{}: {} regions chunks'.format(shard_index, shard_count,
+            len(regions_chunks)))
+    else:
+        regions_chunks = list(get_regions_chunks(bam_filename, nts_in_regions, targets,
+            include_contigs, exclude_contigs))
+        table_prefix = out_prefix
+    chunk_reads = estimate_regions_reads(bam_filename, regions_chunks)
+    total_reads = int(sum(chunk_reads))
+    done_reads = [0]
+
+    def report_reads_done(reads):
+        done_reads[0] += reads
+        mt.report_progress(int(done_reads[0]), total_reads, start_time)
+
+    if max_memory:
+        records = call_regions_chunks_in_budget(bam_filename, out_dir, regions_chunks,
+            chunk_reads, max_memory, rand_str, processes, max_depth, worker_reference_filename,
+            worker_threads, report_reads_done if progress else None)
+    else:
+        p = Pool(processes)
+        results = []
+        for chunk_idx, regions in enumerate(regions_chunks):
+            callback = None
+            if progress:
+                callback = lambda records, chunk_idx=chunk_idx: report_reads_done(
+                    chunk_reads[chunk_idx])
+            results.append(p.apply_async(
+                write_meth_data_by_regions,
+                (bam_filename, out_dir, regions, rand_str, max_depth, worker_reference_filename,
+                    worker_threads),
+                callback=callback,
+            ))
+        p.close()
+        p.join()
+        records = []
+        for result in results:
+            records += result.get()
+    chunk_records = [r for r in records if r['stage']=='calling_chunk']
+    records.append(mt.make_record(
+        'calling',
+        start_time,
+        name=bam_filename,
+        reads=sum(r['reads'] for r in chunk_records),
+        reads_skipped=sum(r['reads_skipped'] for r in chunk_records),
+        bytes_read=mt.get_file_size(bam_filename),
+    ))
+    if max_depth:
+        print('{} of {} reads were skipped by the maximum depth {}'.format(
+            records[-1]['reads_skipped'], records[-1]['reads'], max_depth))
 
     prefix = 'tmp_{0}_'.format(rand_str)
     meth_type_filenames_dict = {}
@@ -402,27 +2471,78 @@ def main(bam_filename, out_prefix, create_bed_file, nts_in_regions=100000000):
 
     print('Merge files...')
 
-    p = Pool()
+    cpg_filename = '{}_CpG.csv.gz'.format(table_prefix)
+    chg_filename = '{}_CHG.csv.gz'.format(table_prefix)
+    chh_filename = '{}_CHH.csv.gz'.format(table_prefix)
+    p = Pool(processes)
+    merge_results = {}
     for meth_type, filenames in meth_type_filenames_dict.iteritems():
-        p.apply_async(
+        merge_results[meth_type] = p.apply_async(
             merge_n_parse,
-            (out_prefix, meth_type, filenames, True),
+            (table_prefix, meth_type, filenames, False),
         )
-    p.close()
-    p.join()
+    # The browser tracks only need the CpG file, so they are made while the
+    # conversion rate is calculated.
+    output_results = []
+    if 'CpG' in merge_results:
+        records += merge_results.pop('CpG').get()
+        if create_bed_file and not shard:
+            output_results.append(p.apply_async(
+                parse_to_bed,
+                (cpg_filename, cpg_filename.replace('.csv.gz', '.bed')),
+            ))
+        if (create_bedgraph or create_bigwig) and not shard:
+            output_results.append(p.apply_async(
+                parse_to_tracks,
+                (cpg_filename, '{}_CpG'.format(out_prefix), get_chrom_sizes(bam_filename),
+                    create_bigwig),
+            ))
+    for result in merge_results.itervalues():
+        records += result.get()
 
-    cpg_filename = '{}_CpG.csv.gz'.format(out_prefix)
-    chg_filename = '{}_CHG.csv.gz'.format(out_prefix)
-    chh_filename = '{}_CHH.csv.gz'.format(out_prefix)
     # Calculate bisulfite conversion rate.
-    conversion_rate = get_bs_conv_rate([
+    conv_start_time = time.time()
+    meth_ratio_sum, count = get_meth_ratio_sum([
         chg_filename,
         chh_filename,
     ])
-    if conversion_rate is not None:
-        print('Bisuflite conversion rate: {:.0%}'.format(conversion_rate))
+    records.append(mt.make_record(
+        'conversion_rate',
+        conv_start_time,
+        bytes_read=mt.get_file_size(chg_filename) + mt.get_file_size(chh_filename),
+    ))
+    for result in output_results:
+        records.append(result.get())
+    p.close()
+    p.join()
+    if shard:
+        # The manifest describes the shard so it can be merged without the BAM file.
+        manifest_filename = '{}.json'.format(table_prefix)
+        tables = {}
+        if os.path.exists(cpg_filename):
+            tables['CpG'] = os.path.basename(cpg_filename)
+        with open(manifest_filename, 'w') as fw:
+            json.dump({
+                'version': __version__,
+                'bam_filename': os.path.abspath(bam_filename),
+                'bam_size': mt.get_file_size(bam_filename),
+                'chrom_sizes': get_chrom_sizes(bam_filename),
+                'shard_index': shard_index,
+                'shard_count': shard_count,
+                'nts_in_regions': nts_in_regions,
+                'max_depth': max_depth,
+                'targets_filename': targets_filename and os.path.abspath(targets_filename),
+                'target_padding': target_padding,
+                'include_contigs': include_contigs,
+                'exclude_contigs': exclude_contigs,
+                'regions_chunks': regions_chunks,
+                'tables': tables,
+                'non_cpg_meth_ratio_sum': meth_ratio_sum,
+                'non_cpg_site_count': count,
+            }, fw, indent=2, sort_keys=True)
+        print('Shard manifest is written to {}'.format(manifest_filename))
     else:
-        print('Cannot estimate bisuflite conversion rate.')
+        print_bs_conv_rate(get_bs_conv_rate([], meth_ratio_sum, count))
     # Remove tmp files after everthing is done.
     for filenames in meth_type_filenames_dict.itervalues():
         for filename in filenames:
@@ -437,4 +2557,8 @@ def main(bam_filename, out_prefix, create_bed_file, nts_in_regions=100000000):
     except OSError:
         pass
 
+    records.append(mt.make_record('total', start_time, name=out_prefix))
+    if metrics_filename:
+        mt.write_metrics(records, metrics_filename)
+        print('Metrics are written to {}'.format(metrics_filename))
     print('Done!')
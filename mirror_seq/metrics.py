@@ -0,0 +1,203 @@
+METRICS_COLUMNS = [
+    'stage',
+    'name',
+    'pid',
+    'wall_time',
+    'reads',
+    'reads_per_sec',
+    'reads_skipped',
+    'sites',
+    'bytes_read',
+    'bytes_written',
+    'peak_rss_kb',
+]
+
+def get_peak_rss():
+    ''' Get the peak resident set size of the current process.
+
+    Returns
+    -------
+    int
+        The peak RSS in kilobytes.
+    '''
+    import resource
+    import sys
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes instead of kilobytes.
+    if sys.platform=='darwin':
+        peak_rss //= 1024
+    return peak_rss
+
+def get_file_size(filename):
+    ''' Get the size of a file, or 0 if it does not exist.
+
+    Parameters
+    ----------
+    filename : str
+        The filename.
+
+    Returns
+    -------
+    int
+        The file size in bytes.
+    '''
+    import os
+
+    try:
+        return os.path.getsize(filename)
+    except (OSError, TypeError):
+        return 0
+
+def make_record(stage, start_time, name=None, **fields):
+    ''' Make a metrics record for a finished stage or region.
+
+    Parameters
+    ----------
+    stage : str
+        The stage name. Eg: trimming, calling_region, merge.
+    start_time : float
+        The time.time() when the stage started.
+    name : str, optional
+        The name of the item processed in this stage. Eg: a region or a filename.
+    **fields
+        Extra metrics, such as reads, sites, bytes_read and bytes_written.
+
+    Returns
+    -------
+    dict
+        The metrics record. reads_per_sec is added if reads is given.
+    '''
+    import os
+    import time
+
+    wall_time = time.time() - start_time
+    record = {
+        'stage': stage,
+        'name': name,
+        'pid': os.getpid(),
+        'wall_time': round(wall_time, 3),
+        'peak_rss_kb': get_peak_rss(),
+    }
+    record.update(fields)
+    if record.get('reads') is not None and wall_time>0:
+        record['reads_per_sec'] = round(record['reads'] / wall_time, 1)
+    return record
+
+def summarize_records(records):
+    ''' Summarize metrics records by stage and by worker process.
+
+    Parameters
+    ----------
+    records : List of dict
+        The records from make_record().
+
+    Returns
+    -------
+    dict
+        with keys "stages" and "workers". "stages" has the count, total and
+        maximum wall time and the summed counters of each stage. "workers" has the
+        peak RSS of each process id.
+    '''
+    stages = {}
+    workers = {}
+    for record in records:
+        summary = stages.setdefault(record['stage'], {
+            'count': 0,
+            'wall_time': 0,
+            'max_wall_time': 0,
+            'slowest': None,
+        })
+        summary['count'] += 1
+        summary['wall_time'] += record['wall_time']
+        if record['wall_time']>=summary['max_wall_time']:
+            summary['max_wall_time'] = record['wall_time']
+            summary['slowest'] = record.get('name')
+        for key in ('reads', 'reads_skipped', 'sites', 'bytes_read', 'bytes_written'):
+            if record.get(key) is not None:
+                summary[key] = summary.get(key, 0) + record[key]
+
+        pid = str(record['pid'])
+        workers[pid] = max(workers.get(pid, 0), record['peak_rss_kb'])
+
+    for summary in stages.itervalues():
+        summary['wall_time'] = round(summary['wall_time'], 3)
+        if summary.get('reads') is not None and summary['wall_time']>0:
+            summary['reads_per_sec'] = round(summary['reads'] / summary['wall_time'], 1)
+
+    return {'stages': stages, 'workers': workers}
+
+def write_metrics(records, metrics_filename):
+    ''' Write metrics records to a JSON or TSV file.
+
+    Parameters
+    ----------
+    records : List of dict
+        The records from make_record().
+    metrics_filename : str
+        The output filename. If it ends with ".json", write records and their
+        summary in JSON. Otherwise, write one record per line in TSV.
+    '''
+    import json
+
+    if metrics_filename.endswith('.json'):
+        with open(metrics_filename, 'w') as fw:
+            json.dump({
+                'summary': summarize_records(records),
+                'records': records,
+            }, fw, indent=2, sort_keys=True)
+        return
+
+    columns = list(METRICS_COLUMNS)
+    for record in records:
+        for key in sorted(record):
+            if key not in columns:
+                columns.append(key)
+
+    with open(metrics_filename, 'w') as fw:
+        fw.write('\t'.join(columns) + '\n')
+        for record in records:
+            values = [record.get(column) for column in columns]
+            fw.write('\t'.join('' if v is None else str(v) for v in values) + '\n')
+
+def format_duration(seconds):
+    ''' Format seconds as H:MM:SS.
+
+    Parameters
+    ----------
+    seconds : float
+        The duration in seconds.
+
+    Returns
+    -------
+    str
+        The formatted duration.
+    '''
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def report_progress(done, total, start_time, unit='reads'):
+    ''' Print the progress and the estimated time to finish.
+
+    Parameters
+    ----------
+    done : int
+        The amount of work done.
+    total : int
+        The total amount of work.
+    start_time : float
+        The time.time() when the work started.
+    unit : str, optional
+        The unit of work shown in the message.
+    '''
+    import time
+
+    elapsed = time.time() - start_time
+    if done>0 and total>0:
+        fraction = min(float(done) / total, 1.0)
+        eta = format_duration(elapsed * (1 - fraction) / fraction)
+    else:
+        fraction = 0.0
+        eta = 'unknown'
+    print('Progress: {:.1%} of ~{} {}, elapsed {}, ETA {}'.format(
+        fraction, total, unit, format_duration(elapsed), eta))
@@ -0,0 +1,206 @@
+def get_file_fingerprint(filename):
+    ''' Get a fingerprint of a file which changes when the file is rewritten.
+
+    Parameters
+    ----------
+    filename : str
+        The filename.
+
+    Returns
+    -------
+    dict
+        with keys "size" and "mtime", or None if the file does not exist.
+    '''
+    import os
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def load_state(state_filename):
+    ''' Load the pipeline state.
+
+    Parameters
+    ----------
+    state_filename : str
+        The JSON state filename.
+
+    Returns
+    -------
+    dict
+        Keys are stage names and values are what save_stage() recorded. Empty if
+        the file does not exist.
+    '''
+    import json
+    import os
+
+    if not os.path.exists(state_filename):
+        return {}
+    with open(state_filename) as f:
+        return json.load(f)
+
+def save_state(state, state_filename):
+    ''' Save the pipeline state.
+
+    Parameters
+    ----------
+    state : dict
+        The state from load_state().
+    state_filename : str
+        The JSON state filename.
+
+    Notes
+    -----
+    * The file is replaced at once, so an interrupted run never leaves a broken state.
+    '''
+    import json
+    import os
+
+    tmp_filename = state_filename + '.tmp'
+    with open(tmp_filename, 'w') as fw:
+        json.dump(state, fw, indent=2, sort_keys=True)
+    os.rename(tmp_filename, state_filename)
+
+def get_stage_signature(inputs, params):
+    ''' Get what a stage result depends on.
+
+    Parameters
+    ----------
+    inputs : List of str
+        The input filenames.
+    params : dict
+        The parameters which change the outputs.
+
+    Returns
+    -------
+    dict
+        The input fingerprints and the parameters, in the same form as they are
+        read back from the state file.
+    '''
+    import json
+
+    return json.loads(json.dumps({
+        'inputs': {filename: get_file_fingerprint(filename) for filename in inputs},
+        'params': params,
+    }))
+
+def is_stage_done(state, stage, inputs, params, outputs):
+    ''' Check if a stage is up to date.
+
+    Parameters
+    ----------
+    state : dict
+        The state from load_state().
+    stage : str
+        The stage name.
+    inputs : List of str
+        The input filenames.
+    params : dict
+        The parameters which change the outputs.
+    outputs : List of str
+        The output filenames.
+
+    Returns
+    -------
+    bool
+        True if the stage finished before with the same inputs and parameters,
+        and its outputs have not been changed or removed since.
+    '''
+    stage_state = state.get(stage)
+    if not stage_state:
+        return False
+    if stage_state['signature']!=get_stage_signature(inputs, params):
+        return False
+    for filename in outputs:
+        fingerprint = get_file_fingerprint(filename)
+        if fingerprint is None or stage_state['outputs'].get(filename)!=fingerprint:
+            return False
+    return True
+
+def run_stage(state, state_filename, stage, func, inputs, params, outputs, force=False):
+    ''' Run a stage unless it is up to date, and record it in the state file.
+
+    Parameters
+    ----------
+    state : dict
+        The state from load_state(). It is updated in place.
+    state_filename : str
+        The JSON state filename.
+    stage : str
+        The stage name.
+    func : function
+        Called without arguments to run the stage.
+    inputs : List of str
+        The input filenames.
+    params : dict
+        The parameters which change the outputs. Thread counts and other
+        settings which do not change the outputs should not be here.
+    outputs : List of str
+        The output filenames.
+    force : bool, optional
+        If True, run the stage even if it is up to date.
+
+    Returns
+    -------
+    bool
+        True if the stage was run, False if it was skipped.
+
+    Notes
+    -----
+    * A rerun stage rewrites its outputs, so the stages using them are rerun too.
+    '''
+    import time
+
+    if not force and is_stage_done(state, stage, inputs, params, outputs):
+        print('Skip {}: the outputs are up to date.'.format(stage))
+        return False
+
+    # Forget the stage first, so a failed run is not taken as done.
+    state.pop(stage, None)
+    save_state(state, state_filename)
+    start_time = time.time()
+    func()
+    missing = [filename for filename in outputs if get_file_fingerprint(filename) is None]
+    if missing:
+        raise Exception('Stage {} did not write {}'.format(stage, ', '.join(missing)))
+    state[stage] = {
+        'signature': get_stage_signature(inputs, params),
+        'outputs': {filename: get_file_fingerprint(filename) for filename in outputs},
+        'wall_time': round(time.time() - start_time, 3),
+    }
+    save_state(state, state_filename)
+    return True
+
+def get_stage_threads(threads=None, non_directional=False):
+    ''' Split a thread budget across the stages.
+
+    Parameters
+    ----------
+    threads : int, optional
+        The total number of threads. Default is the number of CPUs.
+    non_directional : bool, optional
+        If True, Bismark runs 4 bowtie2 instances instead of 2.
+
+    Returns
+    -------
+    dict
+        The threads of "trimming" (per input Fastq, as read 1 and read 2 are read
+        together), "bismark" (its -p, per bowtie2 instance), "sort" (samtools sort
+        -@) and "calling" (see hmc_calling.main()).
+
+    Notes
+    -----
+    * The stages run one after another, so each of them can use the whole budget.
+    '''
+    import multiprocessing
+
+    threads = threads or multiprocessing.cpu_count()
+    bowtie2_instances = 4 if non_directional else 2
+    return {
+        'trimming': max(1, threads // 2),
+        'bismark': max(1, threads // bowtie2_instances),
+        'sort': threads,
+        'calling': threads,
+    }
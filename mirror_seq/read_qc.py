@@ -0,0 +1,223 @@
+BASES = 'ACGTN'
+QUALITY_OFFSET = 33
+QUALITY_BINS = 94
+QC_BATCH_SIZE = 100000
+
+def make_qc_stats(max_len):
+    ''' Make empty read QC statistics.
+
+    Parameters
+    ----------
+    max_len : int
+        The number of read positions tracked. Bases and qualities beyond it are
+        not counted per position, and longer reads share the last length bin.
+
+    Returns
+    -------
+    dict
+        with keys "reads", "clipped", "base_counts" (positions x ACGTN),
+        "quality_counts" (positions x Phred scores 0-93) and "length_counts"
+        (lengths 0 to max_len, then longer).
+    '''
+    import numpy as np
+
+    return {
+        'reads': 0,
+        'clipped': 0,
+        'base_counts': np.zeros((max_len, len(BASES)), dtype=np.int64),
+        'quality_counts': np.zeros((max_len, QUALITY_BINS), dtype=np.int64),
+        'length_counts': np.zeros(max_len+2, dtype=np.int64),
+    }
+
+def merge_qc_stats(stats1, stats2):
+    ''' Merge two read QC statistics, eg: of two batches, workers or lanes.
+
+    Parameters
+    ----------
+    stats1 : dict
+        The statistics from make_qc_stats(). It is updated in place.
+    stats2 : dict
+        The statistics to add. It must have the same max_len.
+
+    Returns
+    -------
+    dict
+        stats1.
+    '''
+    if stats1['base_counts'].shape!=stats2['base_counts'].shape:
+        raise Exception('Cannot merge QC statistics of different read lengths.')
+    for key in ('reads', 'clipped', 'base_counts', 'quality_counts', 'length_counts'):
+        stats1[key] += stats2[key]
+    return stats1
+
+def get_batch_qc_stats(sequences, qualities, clipped, max_len):
+    ''' Count the read QC statistics of a batch of reads at once.
+
+    Parameters
+    ----------
+    sequences : List of str
+        The read sequences.
+    qualities : List of str
+        The quality strings, as long as their sequences.
+    clipped : int
+        The number of reads in this batch which were clipped.
+    max_len : int
+        The number of read positions tracked.
+
+    Returns
+    -------
+    dict
+        The statistics, in the same form as make_qc_stats().
+    '''
+    import numpy as np
+
+    stats = make_qc_stats(max_len)
+    stats['reads'] = len(sequences)
+    stats['clipped'] = clipped
+    if not sequences:
+        return stats
+
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64,
+        count=len(sequences))
+    stats['length_counts'] += np.bincount(np.minimum(lengths, max_len+1),
+        minlength=max_len+2)
+
+    # Position of every base in its read.
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    in_range = positions<max_len
+    positions = positions[in_range]
+
+    base_codes = np.full(256, BASES.index('N'), dtype=np.int64)
+    for i, base in enumerate(BASES):
+        base_codes[ord(base)] = i
+        base_codes[ord(base.lower())] = i
+    bases = base_codes[np.frombuffer(''.join(sequences), dtype=np.uint8)][in_range]
+    stats['base_counts'] += np.bincount(positions*len(BASES) + bases,
+        minlength=max_len*len(BASES)).reshape(max_len, len(BASES))
+
+    scores = np.frombuffer(''.join(qualities), dtype=np.uint8).astype(np.int64)
+    scores = np.clip(scores - QUALITY_OFFSET, 0, QUALITY_BINS-1)[in_range]
+    stats['quality_counts'] += np.bincount(positions*QUALITY_BINS + scores,
+        minlength=max_len*QUALITY_BINS).reshape(max_len, QUALITY_BINS)
+    return stats
+
+def make_qc_batch():
+    ''' Make an empty batch of reads waiting to be counted.
+
+    Returns
+    -------
+    dict
+        with keys "sequences", "qualities" and "clipped".
+    '''
+    return {'sequences': [], 'qualities': [], 'clipped': 0}
+
+def flush_qc_batch(stats, batch):
+    ''' Count a batch of reads into the statistics and empty the batch.
+
+    Parameters
+    ----------
+    stats : dict
+        The statistics from make_qc_stats(). It is updated in place.
+    batch : dict
+        The batch from make_qc_batch(). It is emptied in place.
+    '''
+    merge_qc_stats(stats, get_batch_qc_stats(batch['sequences'], batch['qualities'],
+        batch['clipped'], stats['base_counts'].shape[0]))
+    batch.update(make_qc_batch())
+
+def add_qc_read(stats, batch, sequence, quality, clipped):
+    ''' Add a read to a batch, and count the batch once it is full.
+
+    Parameters
+    ----------
+    stats : dict
+        The statistics from make_qc_stats(). It is updated in place.
+    batch : dict
+        The batch from make_qc_batch(). It is updated in place.
+    sequence : str
+        The read sequence.
+    quality : str
+        The quality string.
+    clipped : bool
+        True if the read was clipped.
+
+    Notes
+    -----
+    * Reads are counted a batch at a time with numpy, which is much faster than
+      counting them one by one. Call flush_qc_batch() after the last read.
+    '''
+    batch['sequences'].append(sequence)
+    batch['qualities'].append(quality)
+    batch['clipped'] += clipped
+    if len(batch['sequences'])>=QC_BATCH_SIZE:
+        flush_qc_batch(stats, batch)
+
+def summarize_qc_stats(stats):
+    ''' Summarize read QC statistics for a JSON report.
+
+    Parameters
+    ----------
+    stats : dict
+        The statistics from make_qc_stats().
+
+    Returns
+    -------
+    dict
+        The read count, the fraction of reads clipped, the length histogram, the
+        overall quality histogram and, per position, the base composition and
+        the mean quality. The per-position counts are kept, so reports can be
+        merged later.
+    '''
+    import numpy as np
+
+    base_counts = stats['base_counts']
+    quality_counts = stats['quality_counts']
+    max_len = base_counts.shape[0]
+    # Only report the positions and the scores which were seen.
+    covered = np.nonzero(base_counts.sum(axis=1))[0]
+    positions = covered[-1] + 1 if len(covered) else 0
+    seen_scores = np.nonzero(quality_counts.sum(axis=0))[0]
+    scores = seen_scores[-1] + 1 if len(seen_scores) else 0
+
+    base_counts = base_counts[:positions]
+    quality_counts = quality_counts[:positions, :scores]
+    depth = base_counts.sum(axis=1).astype(float)
+    length_counts = {}
+    for length in np.nonzero(stats['length_counts'])[0]:
+        label = str(length) if length<=max_len else '>{}'.format(max_len)
+        length_counts[label] = int(stats['length_counts'][length])
+
+    return {
+        'reads': int(stats['reads']),
+        'clipped': int(stats['clipped']),
+        'clipped_fraction': round(float(stats['clipped']) / stats['reads'], 6)
+            if stats['reads'] else None,
+        'length_counts': length_counts,
+        'quality_counts': quality_counts.sum(axis=0).tolist(),
+        'per_position': {
+            'base_fractions': {base: np.round(base_counts[:, i] / depth, 6).tolist()
+                for i, base in enumerate(BASES)},
+            'mean_quality': np.round(quality_counts.dot(np.arange(scores)) / depth,
+                3).tolist(),
+            'base_counts': base_counts.tolist(),
+            'quality_counts': quality_counts.tolist(),
+        },
+    }
+
+def write_qc_report(stats_by_read, qc_filename):
+    ''' Write read QC statistics into a JSON file.
+
+    Parameters
+    ----------
+    stats_by_read : dict
+        Keys are read names (eg: "read1", "read2") and values are from
+        make_qc_stats().
+    qc_filename : str
+        The output filename.
+    '''
+    import json
+
+    with open(qc_filename, 'w') as fw:
+        json.dump({read: summarize_qc_stats(stats) for read, stats in
+            stats_by_read.iteritems()}, fw, indent=2, sort_keys=True)
@@ -0,0 +1,107 @@
+import unittest
+from mirror_seq import fastq
+import os
+
+class TestFastq(unittest.TestCase):
+    def test_read_fastq(self):
+        records = self.read_records(fastq.read_fastq(self.fastq_filename))
+        self.assertEqual(self.expected_records, records)
+
+    def test_read_fastq_gzipped_file(self):
+        import gzip
+
+        gzipped_filename = self.fastq_filename + '.gz'
+        # Two gzip members, as made by concatenating gzipped files.
+        with open(gzipped_filename, 'wb') as fw:
+            for text in (self.fastq_text[:100], self.fastq_text[100:]):
+                with gzip.GzipFile(fileobj=fw, mode='wb') as gz:
+                    gz.write(text)
+
+        self.assertFalse(fastq.is_bgzf(gzipped_filename))
+        records = self.read_records(fastq.read_fastq(gzipped_filename))
+        self.assertEqual(self.expected_records, records)
+
+    def test_read_fastq_bgzf_file(self):
+        import pysam
+
+        bgzf_filename = self.fastq_filename + '.gz'
+        pysam.tabix_compress(self.fastq_filename, bgzf_filename)
+
+        self.assertTrue(fastq.is_bgzf(bgzf_filename))
+        for threads in (1, 3):
+            records = self.read_records(fastq.read_fastq(bgzf_filename, threads))
+            self.assertEqual(self.expected_records, records)
+
+    def test_read_fastq_bgzf_batches(self):
+        import gzip
+        import pysam
+
+        # Several batches of blocks, with records across block boundaries.
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'test_R1.fastq.gz')
+        with gzip.open(filename) as f, open(self.fastq_filename, 'w') as fw:
+            fw.write(f.read())
+        bgzf_filename = self.fastq_filename + '.gz'
+        pysam.tabix_compress(self.fastq_filename, bgzf_filename)
+        expected_result = self.read_records(pysam.FastxFile(self.fastq_filename))
+
+        batch_blocks = fastq.BGZF_BATCH_BLOCKS
+        fastq.BGZF_BATCH_BLOCKS = 2
+        try:
+            records = self.read_records(fastq.read_fastq(bgzf_filename, threads=2))
+        finally:
+            fastq.BGZF_BATCH_BLOCKS = batch_blocks
+        self.assertEqual(1564, len(records))
+        self.assertEqual(expected_result, records)
+
+    def test_read_fastq_stop_early(self):
+        import threading
+        import pysam
+
+        bgzf_filename = self.fastq_filename + '.gz'
+        pysam.tabix_compress(self.fastq_filename, bgzf_filename)
+        thread_count = threading.active_count()
+        fastq_file = fastq.read_fastq(bgzf_filename)
+        self.assertEqual(self.expected_records[:1], self.read_records([fastq_file.next()]))
+        fastq_file.close()
+        self.assertEqual(thread_count, threading.active_count())
+
+    def test_read_fastq_corrupted_file(self):
+        gzipped_filename = self.fastq_filename + '.gz'
+        with open(gzipped_filename, 'wb') as fw:
+            fw.write(fastq.GZIP_MAGIC + 'not a gzip stream')
+
+        with self.assertRaises(Exception):
+            list(fastq.read_fastq(gzipped_filename))
+
+    def read_records(self, fastq_file):
+        return [(read.name, read.comment, read.sequence, read.quality) for read in fastq_file]
+
+    def setUp(self):
+        import tempfile
+
+        self.read_count = 20
+        self.expected_records = []
+        lines = []
+        for i in range(self.read_count):
+            comment = '1:N:0:TGACCC' if i%2 else None
+            sequence = 'ACGT' * (i+1)
+            quality = 'F' * len(sequence)
+            self.expected_records.append(('read{}'.format(i), comment, sequence, quality))
+            header = '@read{}'.format(i)
+            if comment:
+                header += ' ' + comment
+            lines += [header, sequence, '+', quality]
+        self.fastq_text = '\n'.join(lines) + '\n'
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.fastq_filename = os.path.join(self.temp_dir, 'test.fastq')
+        with open(self.fastq_filename, 'w') as fw:
+            fw.write(self.fastq_text)
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.temp_dir)
+
+if __name__=='__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ from pandas.util.testing import assert_frame_equal
 import pandas as pd
 from mirror_seq import hmc_calling
 import os
+import json
 
 class TestHmc_calling(unittest.TestCase):
     def test_mirror_seq_conversion(self):
@@ -79,6 +80,85 @@ class TestHmc_calling(unittest.TestCase):
             results,
             list(hmc_calling.meth_call_for_read(samfile.fetch('Amplicon4').next()))
         )
+    def test_get_reference_positions(self):
+        import pysam
+
+        samfile = pysam.AlignmentFile(os.path.join(self.data_folder, 'test.bam'))
+        for read in samfile.fetch():
+            self.assertEqual(
+                read.get_reference_positions(),
+                hmc_calling.get_reference_positions(read.reference_start, read.cigartuples)
+            )
+        self.assertEqual(
+            [10, 11, 14, 15, 16],
+            hmc_calling.get_reference_positions(10, [(4, 3), (0, 2), (2, 2), (0, 1), (1, 1), (0, 2)])
+        )
+
+    def test_stream_meth_call(self):
+        import pysam
+        import random
+
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        unsorted_bam_filename = os.path.join(self.temp_dir, 'unsorted.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        cpg_filename = os.path.join(self.temp_dir, 'stream_CpG.csv')
+        with pysam.AlignmentFile(bam_filename) as samfile:
+            reads = list(samfile.fetch())
+            random.Random(0).shuffle(reads)
+            with pysam.AlignmentFile(unsorted_bam_filename, 'wb', template=samfile) as fw:
+                for read in reads:
+                    fw.write(read)
+
+        hmc_calling.main(bam_filename, out_prefix, False)
+        # Small batches and buckets to sum calls across batches and buckets.
+        meth_ratio_sum, count, _ = hmc_calling.stream_meth_call(unsorted_bam_filename,
+            self.temp_dir, 'TEST', cpg_filename, processes=2, batch_size=2, bucket_size=20)
+
+        assert_frame_equal(pd.read_csv(out_prefix + '_CpG.csv.gz'), pd.read_csv(cpg_filename))
+        self.assertEqual(0.96, hmc_calling.get_bs_conv_rate([], meth_ratio_sum, count))
+        self.assertEqual(['stream_CpG.csv', 'test_CpG.csv.gz', 'unsorted.bam'],
+            sorted(os.listdir(self.temp_dir)))
+
+    def test_main_bed_file(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+
+        # Small regions chunks, so the rows come from several temp files.
+        hmc_calling.main(bam_filename, out_prefix, False, 100)
+        self.assertEqual(['test_CpG.csv.gz'], os.listdir(self.temp_dir))
+        df = pd.read_csv(out_prefix + '_CpG.csv.gz')
+        assert_frame_equal(df.sort_values(['chrom', 'pos', 'strand']).reset_index(drop=True),
+            df)
+
+        hmc_calling.main(bam_filename, out_prefix, True, 100)
+        self.assertEqual(['test_CpG.bed.gz', 'test_CpG.csv.gz'],
+            sorted(os.listdir(self.temp_dir)))
+        bed_df = pd.read_csv(out_prefix + '_CpG.bed.gz', sep='\t', header=None)
+        self.assertEqual(len(df), len(bed_df))
+
+    def test_main_estimate_options(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        for create_bed_file, options in ((False, {'shard': (1, 2)}),
+            (False, {'targets_filename': out_prefix + '.bed'}), (False, {'target_padding': 10}),
+            (False, {'max_depth': 10}), (False, {'max_memory': 1000}), (True, {}),
+            (False, {'create_bedgraph': True}), (False, {'create_bigwig': True})):
+            with self.assertRaises(ValueError):
+                hmc_calling.main(bam_filename, out_prefix, create_bed_file, estimate=True,
+                    **options)
+        # Rejected before any work.
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_main_unsorted_options(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        for options in ({'max_depth': 10}, {'shard': (1, 2)}, {'max_memory': 1000},
+            {'estimate': True}):
+            with self.assertRaises(ValueError):
+                hmc_calling.main(bam_filename, out_prefix, False, unsorted=True, **options)
+        # Rejected before any work.
+        self.assertEqual([], os.listdir(self.temp_dir))
+
     def test_meth_call_by_region(self):
         chrom = 'Amplicon1'
         bam_filename = os.path.join(self.data_folder, 'test.bam')
@@ -93,6 +173,614 @@ class TestHmc_calling(unittest.TestCase):
 
         assert_frame_equal(expected_df, df, check_dtype=False)
 
+    def test_meth_call_by_region_metrics(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        records = []
+
+        df = hmc_calling.meth_call_by_region(bam_filename, chrom='Amplicon1', metrics=records)
+
+        self.assertEqual(1, len(records))
+        self.assertEqual('calling_region', records[0]['stage'])
+        self.assertEqual('Amplicon1:None-None', records[0]['name'])
+        self.assertEqual(3, records[0]['reads'])
+        self.assertEqual(len(df), records[0]['sites'])
+
+    def test_meth_call_by_region_max_depth(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        records = []
+
+        # The three reads of Amplicon1 start at the same position.
+        df = hmc_calling.meth_call_by_region(bam_filename, chrom='Amplicon1', metrics=records,
+            max_depth=1)
+
+        self.assertEqual(2, records[0]['reads_skipped'])
+        self.assertEqual(17, len(df))
+        self.assertTrue((df['total_count']==1).all())
+
+    def test_meth_call_by_region_max_depth_pairs(self):
+        # Pair p1 is kept, then p2 starts at depth 1, then the read 2 of p1 starts
+        # at depth 2. Pair p3 starts at depth 2, so both of its mates are skipped.
+        meth_codes = 'Z' * 30
+        bam_filename = self.make_bam([
+            ('p1', 99, 100, 110, meth_codes),
+            ('p1', 147, 110, 100, meth_codes),
+            ('p2', 99, 101, 300, meth_codes),
+            ('p2', 147, 300, 101, meth_codes),
+            ('p3', 99, 102, 400, meth_codes),
+            ('p3', 147, 400, 102, meth_codes),
+        ])
+        records = []
+
+        df = hmc_calling.meth_call_by_region(bam_filename, chrom='chr1', metrics=records,
+            max_depth=2)
+        total_counts = df.groupby('pos')['total_count'].sum()
+
+        self.assertEqual(2, records[0]['reads_skipped'])
+        # Read 1 of p1 leaves 110-129 to its read 2, which is kept with it.
+        self.assertEqual(2, total_counts[115])
+        self.assertEqual(1, total_counts[135])
+        self.assertEqual(30, total_counts.loc[300:].sum())
+        self.assertNotIn(400, total_counts.index)
+
+    def test_meth_call_by_regions(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        regions = [('Amplicon1', 0, 40), ('Amplicon1', 41, 175), ('Amplicon4', None, None)]
+        records = []
+
+        expected_df = pd.concat([hmc_calling.meth_call_by_region(bam_filename, *region)
+            for region in regions], ignore_index=True)
+        df = hmc_calling.meth_call_by_regions(bam_filename, regions, metrics=records)
+        assert_frame_equal(expected_df, df.reset_index(drop=True))
+        self.assertEqual(1, len(records))
+        self.assertEqual(3, records[0]['regions'])
+
+    def test_meth_call_by_regions_read_at_end(self):
+        # r2 starts at 100, the inclusive end of the first region.
+        reads = [('r1', 0, 20, -1, 'Z'*50), ('r2', 0, 100, -1, 'Z'*50), ('r3', 0, 150, -1, 'Z'*50)]
+        bam_filename = self.make_bam(reads, 300)
+
+        expected_df = hmc_calling.meth_call_by_regions(bam_filename, [('chr1', None, None)])
+        df = hmc_calling.meth_call_by_regions(bam_filename, [('chr1', 0, 100), ('chr1', 101, 200)])
+        assert_frame_equal(expected_df.reset_index(drop=True), df.reset_index(drop=True))
+        # The + call of r2 at 100 is reported at 101 on the - strand.
+        self.assertEqual(1, df.loc[df['pos']==101, 'total_count'].sum())
+
+    def test_get_regions_chunks_small_contigs(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+
+        # Amplicon7 and Amplicon8 are large. The others are packed in the header order.
+        regions_chunks = list(hmc_calling.get_regions_chunks(bam_filename, 178))
+        self.assertEqual([('Amplicon7', 0, 177)], regions_chunks[0])
+        self.assertEqual([('Amplicon8', 0, 177)], regions_chunks[1])
+        self.assertEqual([
+            [('Amplicon1', 0, 174), ('Amplicon2', 0, 171)],
+            [('Amplicon3', 0, 174), ('Amplicon4', 0, 172)],
+            [('Amplicon5', 0, 174), ('Amplicon6', 0, 172)],
+            [('Amplicon9', 0, 169)],
+        ], regions_chunks[2:])
+
+    def test_get_regions_chunks_contig_end(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+
+        # The last position of the 178 nt Amplicon7 is 177, so no region starts after it.
+        self.assertEqual([[('Amplicon7', 0, 176)], [('Amplicon7', 177, 177)]],
+            list(hmc_calling.get_regions_chunks(bam_filename, 177,
+            include_contigs=['Amplicon7'])))
+        for nts_in_regions in (1, 2, 59, 89, 177, 178, 1000):
+            regions = [region for regions in hmc_calling.get_regions_chunks(bam_filename,
+                nts_in_regions, include_contigs=['Amplicon7']) for region in regions]
+            self.assertEqual(range(178), [pos for _, start, end in regions
+                for pos in range(start, end + 1)])
+            # Every chunk but the last one has nts_in_regions positions.
+            self.assertTrue(all(end - start + 1==min(nts_in_regions, 178)
+                for _, start, end in regions[:-1]))
+
+    def test_meth_call_by_region_cram(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        reference_filename, cram_filename = self.make_cram()
+
+        expected_df = hmc_calling.meth_call_by_region(bam_filename, chrom='Amplicon4')
+        df = hmc_calling.meth_call_by_region(cram_filename, chrom='Amplicon4',
+            reference_filename=reference_filename, threads=2)
+        assert_frame_equal(expected_df, df)
+
+    def test_populate_ref_cache(self):
+        import hashlib
+
+        reference_filename, _ = self.make_cram()
+        ref_cache_dir = os.path.join(self.temp_dir, 'ref_cache')
+
+        # Poly-A sequences of the same length share one cache file.
+        self.assertEqual(5, hmc_calling.populate_ref_cache(reference_filename, ref_cache_dir))
+        self.assertEqual(0, hmc_calling.populate_ref_cache(reference_filename, ref_cache_dir))
+        md5 = hashlib.md5('A'*175).hexdigest()
+        cache_filename = os.path.join(ref_cache_dir, md5[:2], md5[2:4], md5[4:])
+        with open(cache_filename) as f:
+            self.assertEqual('A'*175, f.read())
+
+    def test_populate_ref_cache_mode(self):
+        import hashlib
+        import stat
+
+        reference_filename, _ = self.make_cram()
+        ref_cache_dir = os.path.join(self.temp_dir, 'ref_cache')
+        umask = os.umask(0o022)
+        try:
+            hmc_calling.populate_ref_cache(reference_filename, ref_cache_dir)
+        finally:
+            os.umask(umask)
+        md5 = hashlib.md5('A'*175).hexdigest()
+        cache_filename = os.path.join(ref_cache_dir, md5[:2], md5[2:4], md5[4:])
+        # Readable by other users sharing the cache.
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(cache_filename).st_mode))
+
+    def test_get_worker_threads(self):
+        self.assertEqual((16, 4), hmc_calling.get_worker_threads(16, 64))
+        self.assertEqual((8, 1), hmc_calling.get_worker_threads(None, 8))
+        self.assertEqual((8, 1), hmc_calling.get_worker_threads(8, None))
+
+    def test_estimate_regions_reads(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        regions_chunks = [
+            [('Amplicon1', 0, 175)],
+            [('Amplicon4', 0, 173), ('Amplicon5', 0, 175)],
+        ]
+
+        estimates = hmc_calling.estimate_regions_reads(bam_filename, regions_chunks)
+        self.assertEqual([3, 2], estimates)
+
+    def test_filter_chroms(self):
+        chroms = ['chr1', 'chr2', 'chr1_alt', 'chrUn_1', 'chrM']
+
+        self.assertEqual(['chr1', 'chr2', 'chrM'],
+            hmc_calling.filter_chroms(chroms, exclude_contigs=['*_alt', 'chrUn_*']))
+        self.assertEqual(['chr1', 'chr2'],
+            hmc_calling.filter_chroms(chroms, ['chr?'], ['chrM']))
+        self.assertEqual(chroms, hmc_calling.filter_chroms(chroms))
+
+    def test_read_targets(self):
+        bed_filename = os.path.join(self.temp_dir, 'targets.bed')
+        with open(bed_filename, 'w') as fw:
+            fw.write('track name=targets\n')
+            fw.write('chr1\t100\t200\tA\n')
+            fw.write('chr2\t5\t10\tB\n')
+            fw.write('chr1\t205\t300\tC\n')
+            fw.write('chr1\t400\t500\tD\n')
+
+        self.assertEqual({
+            'chr1': [(95, 305), (395, 505)],
+            'chr2': [(0, 15)],
+        }, hmc_calling.read_targets(bed_filename, padding=5))
+
+    def test_get_regions_chunks_targets(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        targets = {
+            'Amplicon1': [(10, 30), (150, 200)],
+            'Amplicon2': [(0, 10)],
+            'Unknown': [(0, 10)],
+        }
+
+        regions_chunks = list(hmc_calling.get_regions_chunks(bam_filename, 100, targets,
+            exclude_contigs=['Amplicon2']))
+        self.assertEqual([[('Amplicon1', 10, 29), ('Amplicon1', 150, 174)]], regions_chunks)
+
+        regions_chunks = list(hmc_calling.get_regions_chunks(bam_filename, 100,
+            include_contigs=['Amplicon[12]']))
+        self.assertEqual([
+            [('Amplicon1', 0, 99)],
+            [('Amplicon1', 100, 174), ('Amplicon2', 0, 99)],
+            [('Amplicon2', 100, 171)],
+        ], regions_chunks)
+
+    def test_split_regions_chunk(self):
+        regions = [('Amplicon1', 0, 175), ('Amplicon2', 0, 172)]
+        expected_chunks = [
+            [('Amplicon1', 0, 116)],
+            [('Amplicon1', 117, 175), ('Amplicon2', 0, 57)],
+            [('Amplicon2', 58, 172)],
+        ]
+
+        self.assertEqual(expected_chunks, hmc_calling.split_regions_chunk(regions, 3))
+        self.assertEqual([regions], hmc_calling.split_regions_chunk(regions, 1))
+        # The ends are included, so no position is lost where a split lands on one.
+        self.assertEqual([[('c', 0, 3)], [('c', 4, 7)], [('c', 8, 10)]],
+            hmc_calling.split_regions_chunk([('c', 0, 10)], 3))
+        self.assertEqual([[('c', 5, 5)]], hmc_calling.split_regions_chunk([('c', 5, 5)], 2))
+        regions = [('c', 0, 100), ('c', 101, 200)]
+        for chunk_count in range(1, 12):
+            positions = [pos for chunk in hmc_calling.split_regions_chunk(regions, chunk_count)
+                for _, start, end in chunk for pos in range(start, end + 1)]
+            self.assertEqual(range(201), positions)
+
+    def test_parse_memory(self):
+        self.assertEqual(16384, hmc_calling.parse_memory('16G'))
+        self.assertEqual(500, hmc_calling.parse_memory('500m'))
+        self.assertEqual(2000, hmc_calling.parse_memory('2000'))
+        with self.assertRaises(ValueError):
+            hmc_calling.parse_memory('lots')
+
+    def test_call_regions_chunks_in_budget(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        regions_chunks = list(hmc_calling.get_regions_chunks(bam_filename))
+        expected_dir = os.path.join(self.temp_dir, 'expected')
+        budget_dir = os.path.join(self.temp_dir, 'budget')
+        os.mkdir(expected_dir)
+        os.mkdir(budget_dir)
+        for regions in regions_chunks:
+            hmc_calling.write_meth_data_by_regions(bam_filename, expected_dir, regions)
+
+        # Overestimated reads make every chunk too large, so they are split.
+        records = hmc_calling.call_regions_chunks_in_budget(bam_filename, budget_dir,
+            regions_chunks, [1e8] * len(regions_chunks), 100000, processes=2)
+        chunk_records = [r for r in records if r['stage']=='calling_chunk']
+        self.assertGreater(len(chunk_records), len(regions_chunks))
+
+        def merge_cpg_tables(out_dir):
+            out_filename = os.path.join(out_dir, 'CpG.csv')
+            filenames = [os.path.join(out_dir, f) for f in os.listdir(out_dir)
+                if f.endswith('_CpG')]
+            hmc_calling.merge_sorted_tables(filenames, out_filename, sum_counts=True)
+            return pd.read_csv(out_filename)
+        assert_frame_equal(merge_cpg_tables(expected_dir), merge_cpg_tables(budget_dir))
+
+    def test_split_regions_chunk_calls(self):
+        # A CpG call at every position, so every lost position shows.
+        reads = [('r{}'.format(start), 0, start, -1, 'Z'*50) for start in range(0, 200, 5)]
+        bam_filename = self.make_bam(reads, 300)
+        regions = [('chr1', 0, 100), ('chr1', 101, 200)]
+        expected_df = hmc_calling.meth_call_by_regions(bam_filename, regions)
+
+        for chunk_count in range(2, 12):
+            df = pd.concat([hmc_calling.meth_call_by_regions(bam_filename, sub_regions)
+                for sub_regions in hmc_calling.split_regions_chunk(regions, chunk_count)])
+            df = df.groupby(['chrom', 'pos', 'strand', 'meth_code'], as_index=False).sum()
+            self.assertEqual(expected_df['total_count'].sum(), df['total_count'].sum())
+            assert_frame_equal(expected_df.reset_index(drop=True), df[expected_df.columns])
+
+    def test_get_estimate_windows(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        chrom_sizes = dict(hmc_calling.get_chrom_sizes(bam_filename))
+
+        windows = hmc_calling.get_estimate_windows(bam_filename, 20, 50, seed=1)
+        self.assertEqual(20, len(windows))
+        self.assertEqual(windows, hmc_calling.get_estimate_windows(bam_filename, 20, 50, seed=1))
+        self.assertNotEqual(windows, hmc_calling.get_estimate_windows(bam_filename, 20, 50, seed=2))
+        for chrom, start, end, weight in windows:
+            self.assertEqual(49, end - start)
+            self.assertLess(end, chrom_sizes[chrom])
+            self.assertGreater(weight, 0)
+
+        windows = hmc_calling.get_estimate_windows(bam_filename, 20, 50,
+            include_contigs=['Amplicon1'])
+        self.assertEqual(set(['Amplicon1']), set(w[0] for w in windows))
+
+    def test_get_ratio_interval(self):
+        ratio, low, high = hmc_calling.get_ratio_interval([1, 2, 3, 6], [10, 20, 30, 40])
+        self.assertAlmostEqual(0.12, ratio)
+        self.assertLess(low, ratio)
+        self.assertGreater(high, ratio)
+        self.assertEqual((0.5, 0.5, 0.5), hmc_calling.get_ratio_interval([1, 2], [2, 4]))
+        self.assertEqual((None, None, None), hmc_calling.get_ratio_interval([0], [0]))
+
+    def test_estimate_meth(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        hmc_calling.main(bam_filename, out_prefix, False)
+        df = pd.read_csv(out_prefix + '_CpG.csv.gz')
+
+        estimates = hmc_calling.estimate_meth(bam_filename, window_count=50)
+        self.assertEqual(50, estimates['windows'])
+        hmc_level, low, high = estimates['hmc_level']
+        self.assertAlmostEqual(float(df['meth_count'].sum()) / df['total_count'].sum(),
+            hmc_level, delta=0.05)
+        self.assertLessEqual(low, hmc_level)
+        self.assertAlmostEqual(df['total_count'].mean(), estimates['cpg_coverage'][0], delta=0.2)
+        self.assertAlmostEqual(0.96, estimates['bs_conv_rate'][0], delta=0.02)
+
+    def test_estimate_meth_deep_windows(self):
+        # 100x everywhere: a 100 nt read starts at every position, with a CpG
+        # call every 10 nt.
+        chrom_size = 20000
+        read_len = 100
+        reads = []
+        for start in range(chrom_size - read_len + 1):
+            meth_codes = ''.join('z' if (start+i)%10==0 else '.' for i in range(read_len))
+            reads.append(('r{}'.format(start), 0, start, -1, meth_codes))
+        bam_filename = self.make_bam(reads, chrom_size)
+
+        estimates = hmc_calling.estimate_meth(bam_filename, window_count=20, window_size=500,
+            max_reads_per_window=100)
+        # Far fewer reads than the ~600 per window are called.
+        self.assertLess(estimates['reads'], 20 * 150)
+        cpg_coverage, low, high = estimates['cpg_coverage']
+        self.assertAlmostEqual(100, cpg_coverage, delta=5)
+        self.assertLessEqual(low, 100)
+        self.assertAlmostEqual(1.0, estimates['hmc_level'][0])
+
+    def test_get_window_read_threshold(self):
+        self.assertIsNone(hmc_calling.get_window_read_threshold(None, 200))
+        self.assertIsNone(hmc_calling.get_window_read_threshold(200, 200))
+        threshold = hmc_calling.get_window_read_threshold(10000, 200)
+        self.assertEqual(2**32 // 50, threshold)
+        # About the expected fraction of the names is kept.
+        kept = sum(hmc_calling.get_read_name_hash('read{}'.format(i))<=threshold
+            for i in range(10000))
+        self.assertAlmostEqual(200, kept, delta=40)
+
+    def test_merge_sorted_tables(self):
+        columns = ['chrom', 'pos', 'strand', 'meth_count', 'total_count']
+        filename1 = os.path.join(self.temp_dir, 'a.csv.gz')
+        filename2 = os.path.join(self.temp_dir, 'b.csv.gz')
+        out_filename = os.path.join(self.temp_dir, 'out.csv')
+        pd.DataFrame([
+            ['chr1', 10, '+', 1, 2],
+            ['chr2', 5, '-', 0, 1],
+        ], columns=columns).to_csv(filename1, compression='gzip', index=False)
+        pd.DataFrame([
+            ['chr1', 9, '+', 3, 3],
+            ['chr1', 10, '-', 1, 1],
+            ['chr10', 1, '+', 1, 1],
+        ], columns=columns).to_csv(filename2, compression='gzip', index=False)
+        expected_df = pd.DataFrame([
+            ['chr1', 9, '+', 3, 3],
+            ['chr1', 10, '+', 1, 2],
+            ['chr1', 10, '-', 1, 1],
+            ['chr10', 1, '+', 1, 1],
+            ['chr2', 5, '-', 0, 1],
+        ], columns=columns)
+
+        row_count = hmc_calling.merge_sorted_tables([filename1, filename2], out_filename)
+        self.assertEqual(5, row_count)
+        assert_frame_equal(expected_df, pd.read_csv(out_filename))
+
+    def test_merge_sorted_tables_sum_counts(self):
+        columns = ['chrom', 'pos', 'strand', 'meth_count', 'total_count']
+        filename1 = os.path.join(self.temp_dir, 'a.csv.gz')
+        filename2 = os.path.join(self.temp_dir, 'b.csv.gz')
+        out_filename = os.path.join(self.temp_dir, 'out.csv')
+        pd.DataFrame([
+            ['chr1', 10, '+', 1, 2],
+            ['chr1', 10, '-', 0, 1],
+            ['chr2', 5, '-', 0, 1],
+        ], columns=columns).to_csv(filename1, compression='gzip', index=False)
+        pd.DataFrame([
+            ['chr1', 10, '+', 3, 3],
+            ['chr2', 5, '-', 1, 1],
+            ['chr2', 8, '+', 1, 1],
+        ], columns=columns).to_csv(filename2, compression='gzip', index=False)
+        expected_df = pd.DataFrame([
+            ['chr1', 10, '+', 4, 5],
+            ['chr1', 10, '-', 0, 1],
+            ['chr2', 5, '-', 1, 2],
+            ['chr2', 8, '+', 1, 1],
+        ], columns=columns)
+
+        row_count = hmc_calling.merge_sorted_tables([filename1, filename2], out_filename,
+            sum_counts=True)
+        self.assertEqual(4, row_count)
+        assert_frame_equal(expected_df, pd.read_csv(out_filename))
+
+    def test_merge_sorted_tables_not_sorted(self):
+        columns = ['chrom', 'pos', 'strand', 'meth_count', 'total_count']
+        filename = os.path.join(self.temp_dir, 'a.csv.gz')
+        out_filename = os.path.join(self.temp_dir, 'out.csv')
+        pd.DataFrame([
+            ['chr2', 5, '-', 0, 1],
+            ['chr1', 10, '+', 1, 2],
+        ], columns=columns).to_csv(filename, compression='gzip', index=False)
+
+        with self.assertRaises(Exception):
+            hmc_calling.merge_sorted_tables([filename], out_filename)
+
+    def test_parse_to_tracks(self):
+        columns = ['chrom', 'pos', 'strand', 'meth_count', 'total_count']
+        filename = os.path.join(self.temp_dir, 'a.csv.gz')
+        track_prefix = os.path.join(self.temp_dir, 'a')
+        pd.DataFrame([
+            ['chr1', 10, '+', 1, 2],
+            ['chr1', 11, '-', 1, 1],
+            ['chr1', 12, '+', 0, 3],
+            ['chr2', 5, '+', 1, 2],
+            ['chr2', 6, '-', 1, 2],
+        ], columns=columns).to_csv(filename, compression='gzip', index=False)
+        expected_ratio_df = pd.DataFrame([
+            ['chr1', 10, 11, 0.6667],
+            ['chr1', 12, 13, 0.0],
+            ['chr2', 5, 6, 0.5],
+        ])
+        expected_coverage_df = pd.DataFrame([
+            ['chr1', 10, 11, 3],
+            ['chr1', 12, 13, 3],
+            ['chr2', 5, 6, 4],
+        ])
+
+        # chunksize 2 splits both CpGs with two strands across chunks.
+        record = hmc_calling.parse_to_tracks(filename, track_prefix, [('chr1', 20), ('chr2', 20)],
+            chunksize=2)
+        self.assertEqual(3, record['sites'])
+        assert_frame_equal(expected_ratio_df,
+            pd.read_csv(track_prefix + '_ratio.bedGraph.gz', sep='\t', header=None))
+        assert_frame_equal(expected_coverage_df,
+            pd.read_csv(track_prefix + '_coverage.bedGraph.gz', sep='\t', header=None))
+
+    def test_parse_to_tracks_main(self):
+        # Forward reads call the C of the CpGs at 110 and 120, and reverse reads
+        # call the G at 111 of the first one.
+        forward_codes = '.'*10 + 'z' + '.'*9 + 'Z' + '.'*9
+        reverse_codes = '.'*11 + 'z' + '.'*18
+        reads = [('f{}'.format(i), 0, 100, -1, forward_codes) for i in range(3)]
+        reads += [('r{}'.format(i), 16, 100, -1, reverse_codes) for i in range(2)]
+        bam_filename = self.make_bam(reads)
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        hmc_calling.main(bam_filename, out_prefix, False, create_bedgraph=True)
+        df = pd.read_csv(out_prefix + '_CpG.csv.gz')
+        self.assertEqual([(110, '+'), (111, '-'), (121, '-')],
+            zip(df['pos'], df['strand']))
+
+        expected_ratio_df = pd.DataFrame([
+            ['chr1', 110, 111, 1.0],
+            ['chr1', 120, 121, 0.0],
+        ])
+        expected_coverage_df = pd.DataFrame([
+            ['chr1', 110, 111, 5],
+            ['chr1', 120, 121, 3],
+        ])
+        assert_frame_equal(expected_ratio_df,
+            pd.read_csv(out_prefix + '_CpG_ratio.bedGraph.gz', sep='\t', header=None))
+        assert_frame_equal(expected_coverage_df,
+            pd.read_csv(out_prefix + '_CpG_coverage.bedGraph.gz', sep='\t', header=None))
+
+    def test_merge_count_tables(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        merged_prefix = os.path.join(self.temp_dir, 'merged')
+
+        hmc_calling.main(bam_filename, out_prefix, False, create_bedgraph=True)
+        hmc_calling.merge_count_tables([out_prefix + '_CpG.csv.gz'] * 2, merged_prefix, False,
+            create_bedgraph=True)
+
+        expected_df = pd.read_csv(out_prefix + '_CpG.csv.gz')
+        expected_df[['meth_count', 'total_count']] *= 2
+        assert_frame_equal(expected_df, pd.read_csv(merged_prefix + '_CpG.csv.gz'))
+        expected_df = pd.read_csv(out_prefix + '_CpG_coverage.bedGraph.gz', sep='\t',
+            header=None)
+        expected_df[3] *= 2
+        assert_frame_equal(expected_df, pd.read_csv(merged_prefix + '_CpG_coverage.bedGraph.gz',
+            sep='\t', header=None))
+        with self.assertRaises(Exception):
+            hmc_calling.merge_count_tables([out_prefix + '_CpG.csv.gz'], merged_prefix, False,
+                create_bigwig=True)
+        with self.assertRaises(Exception):
+            hmc_calling.merge_count_tables([out_prefix + '_CpG.csv.gz'], out_prefix, False)
+
+    def test_parse_shard(self):
+        self.assertEqual((3, 10), hmc_calling.parse_shard('3/10'))
+        with self.assertRaises(ValueError):
+            hmc_calling.parse_shard('0/10')
+        with self.assertRaises(ValueError):
+            hmc_calling.parse_shard('3')
+
+    def test_get_shard_regions_chunks(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        regions_chunks = list(hmc_calling.get_regions_chunks(bam_filename, 178))
+
+        shard_regions_chunks = []
+        for shard_index in (1, 2, 3):
+            shard_regions_chunks += hmc_calling.get_shard_regions_chunks(bam_filename,
+                shard_index, 3, 178)
+        self.assertEqual(sorted(regions_chunks), sorted(shard_regions_chunks))
+        # Amplicon1 and Amplicon2 have the most reads so they take the first shard alone.
+        self.assertEqual(
+            [[('Amplicon1', 0, 174), ('Amplicon2', 0, 171)]],
+            hmc_calling.get_shard_regions_chunks(bam_filename, 1, 3, 178)
+        )
+
+    def test_merge_shards(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        out_prefix = os.path.join(self.temp_dir, 'test')
+        shard_prefix = os.path.join(self.temp_dir, 'shard')
+
+        hmc_calling.main(bam_filename, out_prefix, False, 100, create_bedgraph=True)
+        for shard_index in (1, 2):
+            hmc_calling.main(bam_filename, shard_prefix, False, 100, shard=(shard_index, 2))
+        manifest_filenames = [
+            '{}_shard{}of2.json'.format(shard_prefix, shard_index) for shard_index in (2, 1)
+        ]
+        with self.assertRaises(Exception):
+            hmc_calling.merge_shards(manifest_filenames[:1], shard_prefix, False)
+        # The BAM file of a node may be at another path.
+        with open(manifest_filenames[0]) as f:
+            manifest = json.load(f)
+        manifest['bam_filename'] = '/scratch/node2/test.bam'
+        with open(manifest_filenames[0], 'w') as fw:
+            json.dump(manifest, fw)
+        hmc_calling.merge_shards(manifest_filenames, shard_prefix, False,
+            create_bedgraph=True)
+
+        expected_df = pd.read_csv(out_prefix + '_CpG.csv.gz')
+        df = pd.read_csv(shard_prefix + '_CpG.csv.gz')
+        assert_frame_equal(expected_df, df)
+        for track in ('ratio', 'coverage'):
+            filename = '{}_CpG_{}.bedGraph.gz'
+            assert_frame_equal(
+                pd.read_csv(filename.format(out_prefix, track), sep='\t', header=None),
+                pd.read_csv(filename.format(shard_prefix, track), sep='\t', header=None))
+
+    def test_merge_shards_different_bam(self):
+        bam_filename = os.path.join(self.data_folder, 'test.bam')
+        shard_prefix = os.path.join(self.temp_dir, 'shard')
+
+        for shard_index in (1, 2):
+            hmc_calling.main(bam_filename, shard_prefix, False, 100, shard=(shard_index, 2))
+        manifest_filenames = [
+            '{}_shard{}of2.json'.format(shard_prefix, shard_index) for shard_index in (1, 2)
+        ]
+        with open(manifest_filenames[1]) as f:
+            manifest = json.load(f)
+        manifest['chrom_sizes'][0][1] += 1
+        with open(manifest_filenames[1], 'w') as fw:
+            json.dump(manifest, fw)
+        with self.assertRaises(Exception):
+            hmc_calling.merge_shards(manifest_filenames, shard_prefix, False)
+
+    def test_read_chrom_sizes(self):
+        filename = os.path.join(self.temp_dir, 'genome.chrom.sizes')
+        with open(filename, 'w') as fw:
+            fw.write('chr1\t1000\nchr2\t20\t7\n\n')
+        self.assertEqual([('chr1', 1000), ('chr2', 20)], hmc_calling.read_chrom_sizes(filename))
+
+        with open(filename, 'w') as fw:
+            fw.write('chr1\n')
+        with self.assertRaises(Exception):
+            hmc_calling.read_chrom_sizes(filename)
+
+    def make_bam(self, reads, chrom_size=10000):
+        ''' Make a sorted and indexed BAM file of Bismark-like reads on chr1.
+
+        reads is a list of (name, flag, start, next_start, XM tag).
+        '''
+        import pysam
+
+        unsorted_bam_filename = os.path.join(self.temp_dir, 'unsorted.bam')
+        bam_filename = os.path.join(self.temp_dir, 'synthetic.bam')
+        header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'chr1', 'LN': chrom_size}]}
+        with pysam.AlignmentFile(unsorted_bam_filename, 'wb', header=header) as fw:
+            for name, flag, start, next_start, meth_codes in reads:
+                read = pysam.AlignedSegment()
+                read.query_name = name
+                read.flag = flag
+                read.reference_id = 0
+                read.reference_start = start
+                read.mapping_quality = 40
+                read.cigar = [(0, len(meth_codes))]
+                read.query_sequence = 'T' * len(meth_codes)
+                read.query_qualities = pysam.qualitystring_to_array('I' * len(meth_codes))
+                if flag & 0x1:
+                    read.next_reference_id = 0
+                    read.next_reference_start = next_start
+                read.set_tag('XM', meth_codes)
+                fw.write(read)
+        pysam.sort('-o', bam_filename, unsorted_bam_filename)
+        pysam.index(bam_filename)
+        return bam_filename
+
+    def make_cram(self):
+        ''' Make a CRAM file of test.bam against a poly-A reference. '''
+        import pysam
+
+        reference_filename = os.path.join(self.temp_dir, 'ref.fa')
+        cram_filename = os.path.join(self.temp_dir, 'test.cram')
+        with pysam.AlignmentFile(os.path.join(self.data_folder, 'test.bam')) as samfile:
+            with open(reference_filename, 'w') as fw:
+                for d in samfile.header['SQ']:
+                    fw.write('>{}\n{}\n'.format(d['SN'], 'A'*d['LN']))
+            pysam.faidx(reference_filename)
+            with pysam.AlignmentFile(cram_filename, 'wc', template=samfile,
+                reference_filename=reference_filename) as fw:
+                for read in samfile.fetch():
+                    fw.write(read)
+        pysam.index(cram_filename)
+        return reference_filename, cram_filename
 
     def setUp(self):
         import tempfile
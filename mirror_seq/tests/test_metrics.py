@@ -0,0 +1,78 @@
+import unittest
+from mirror_seq import metrics
+import os
+
+class TestMetrics(unittest.TestCase):
+    def test_make_record(self):
+        import time
+
+        record = metrics.make_record('calling_region', time.time() - 2, name='chr1:0-100',
+            reads=100)
+
+        self.assertEqual('calling_region', record['stage'])
+        self.assertEqual('chr1:0-100', record['name'])
+        self.assertEqual(os.getpid(), record['pid'])
+        self.assertGreater(record['peak_rss_kb'], 0)
+        self.assertAlmostEqual(50, record['reads_per_sec'], delta=5)
+
+    def test_summarize_records(self):
+        records = [
+            {'stage': 'calling_region', 'name': 'a', 'pid': 1, 'wall_time': 1.0,
+                'reads': 10, 'sites': 5, 'peak_rss_kb': 100},
+            {'stage': 'calling_region', 'name': 'b', 'pid': 2, 'wall_time': 3.0,
+                'reads': 20, 'sites': 7, 'peak_rss_kb': 300},
+            {'stage': 'calling_region', 'name': 'c', 'pid': 1, 'wall_time': 2.0,
+                'reads': 30, 'sites': 9, 'peak_rss_kb': 200},
+        ]
+
+        summary = metrics.summarize_records(records)
+        stage_summary = summary['stages']['calling_region']
+        self.assertEqual(3, stage_summary['count'])
+        self.assertEqual(6.0, stage_summary['wall_time'])
+        self.assertEqual(3.0, stage_summary['max_wall_time'])
+        self.assertEqual('b', stage_summary['slowest'])
+        self.assertEqual(60, stage_summary['reads'])
+        self.assertEqual(21, stage_summary['sites'])
+        self.assertEqual({'1': 200, '2': 300}, summary['workers'])
+
+    def test_write_metrics(self):
+        import json
+
+        records = [
+            {'stage': 'merge', 'name': 'x', 'pid': 1, 'wall_time': 1.0,
+                'sites': 5, 'peak_rss_kb': 100, 'extra': 'y'},
+        ]
+        tsv_filename = os.path.join(self.temp_dir, 'metrics.tsv')
+        json_filename = os.path.join(self.temp_dir, 'metrics.json')
+        metrics.write_metrics(records, tsv_filename)
+        metrics.write_metrics(records, json_filename)
+
+        with open(tsv_filename) as f:
+            lines = [line.rstrip('\n').split('\t') for line in f]
+        self.assertEqual(metrics.METRICS_COLUMNS + ['extra'], lines[0])
+        row = dict(zip(lines[0], lines[1]))
+        self.assertEqual('merge', row['stage'])
+        self.assertEqual('', row['reads'])
+        self.assertEqual('y', row['extra'])
+
+        with open(json_filename) as f:
+            data = json.load(f)
+        self.assertEqual(records, data['records'])
+        self.assertEqual(1, data['summary']['stages']['merge']['count'])
+
+    def test_format_duration(self):
+        self.assertEqual('0:00:05', metrics.format_duration(5))
+        self.assertEqual('1:01:01', metrics.format_duration(3661))
+
+    def setUp(self):
+        import tempfile
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.temp_dir)
+
+if __name__=='__main__':
+    unittest.main()
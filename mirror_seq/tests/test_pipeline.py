@@ -0,0 +1,73 @@
+import unittest
+from mirror_seq import pipeline
+import os
+
+class TestPipeline(unittest.TestCase):
+    def test_run_stage(self):
+        input_filename = os.path.join(self.temp_dir, 'in.txt')
+        output_filename = os.path.join(self.temp_dir, 'out.txt')
+        state_filename = os.path.join(self.temp_dir, 'state.json')
+        runs = []
+        with open(input_filename, 'w') as fw:
+            fw.write('A')
+
+        def copy():
+            runs.append(1)
+            with open(input_filename) as f, open(output_filename, 'w') as fw:
+                fw.write(f.read())
+
+        def run_stage(params, force=False):
+            state = pipeline.load_state(state_filename)
+            return pipeline.run_stage(state, state_filename, 'copy', copy, [input_filename],
+                params, [output_filename], force)
+
+        self.assertTrue(run_stage({'n': 1}))
+        self.assertFalse(run_stage({'n': 1}))
+        # Parameters changed.
+        self.assertTrue(run_stage({'n': 2}))
+        self.assertFalse(run_stage({'n': 2}))
+        self.assertTrue(run_stage({'n': 2}, force=True))
+        # Input changed.
+        with open(input_filename, 'w') as fw:
+            fw.write('AB')
+        self.assertTrue(run_stage({'n': 2}))
+        # Output removed.
+        os.remove(output_filename)
+        self.assertTrue(run_stage({'n': 2}))
+        self.assertEqual(5, len(runs))
+
+    def test_run_stage_failed(self):
+        output_filename = os.path.join(self.temp_dir, 'out.txt')
+        state_filename = os.path.join(self.temp_dir, 'state.json')
+        state = {}
+
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            pipeline.run_stage(state, state_filename, 'fail', fail, [], {}, [output_filename])
+        with self.assertRaises(Exception):
+            pipeline.run_stage(state, state_filename, 'fail', lambda: None, [], {},
+                [output_filename])
+        self.assertEqual({}, pipeline.load_state(state_filename))
+
+    def test_get_stage_threads(self):
+        self.assertEqual({'trimming': 4, 'bismark': 4, 'sort': 8, 'calling': 8},
+            pipeline.get_stage_threads(8))
+        self.assertEqual({'trimming': 4, 'bismark': 2, 'sort': 8, 'calling': 8},
+            pipeline.get_stage_threads(8, non_directional=True))
+        self.assertEqual(1, pipeline.get_stage_threads(1)['bismark'])
+        self.assertEqual(1, pipeline.get_stage_threads(1)['trimming'])
+
+    def setUp(self):
+        import tempfile
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.temp_dir)
+
+if __name__=='__main__':
+    unittest.main()
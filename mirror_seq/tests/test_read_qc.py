@@ -0,0 +1,73 @@
+import unittest
+from mirror_seq import read_qc
+
+class TestReadQc(unittest.TestCase):
+    def test_get_batch_qc_stats(self):
+        sequences = ['ACGN', 'AC', 'acgtAA']
+        qualities = ['IIII', '!#', 'IIIIII']
+        max_len = 4
+
+        stats = read_qc.get_batch_qc_stats(sequences, qualities, 1, max_len)
+        self.assertEqual(3, stats['reads'])
+        self.assertEqual(1, stats['clipped'])
+        self.assertEqual([[3, 0, 0, 0, 0], [0, 3, 0, 0, 0], [0, 0, 2, 0, 0],
+            [0, 0, 0, 1, 1]], stats['base_counts'].tolist())
+        # Phred scores: I is 40, ! is 0 and # is 2.
+        self.assertEqual(2, stats['quality_counts'][0, 40])
+        self.assertEqual(1, stats['quality_counts'][0, 0])
+        self.assertEqual(1, stats['quality_counts'][1, 2])
+        self.assertEqual(10, stats['quality_counts'].sum())
+        self.assertEqual([0, 0, 1, 0, 1, 1], stats['length_counts'].tolist())
+
+    def test_merge_qc_stats(self):
+        sequences = ['ACGT', 'AC', 'GGGTT', 'A']
+        qualities = ['IIII', 'II', 'IIIII', '5']
+        max_len = 4
+
+        expected_result = read_qc.get_batch_qc_stats(sequences, qualities, 2, max_len)
+        result = read_qc.make_qc_stats(max_len)
+        for i in (0, 2):
+            read_qc.merge_qc_stats(result, read_qc.get_batch_qc_stats(sequences[i:i+2],
+                qualities[i:i+2], 1, max_len))
+        for key in ('reads', 'clipped', 'base_counts', 'quality_counts', 'length_counts'):
+            self.assertEqual(np_list(expected_result[key]), np_list(result[key]))
+
+        with self.assertRaises(Exception):
+            read_qc.merge_qc_stats(result, read_qc.make_qc_stats(max_len+1))
+
+    def test_add_qc_read(self):
+        stats = read_qc.make_qc_stats(3)
+        batch = read_qc.make_qc_batch()
+        batch_size = read_qc.QC_BATCH_SIZE
+        read_qc.QC_BATCH_SIZE = 2
+        try:
+            for seq in ('ACG', 'TTT', 'CC'):
+                read_qc.add_qc_read(stats, batch, seq, 'I'*len(seq), seq=='CC')
+        finally:
+            read_qc.QC_BATCH_SIZE = batch_size
+        self.assertEqual(2, stats['reads'])
+        self.assertEqual(['CC'], batch['sequences'])
+
+        read_qc.flush_qc_batch(stats, batch)
+        self.assertEqual(3, stats['reads'])
+        self.assertEqual(1, stats['clipped'])
+        self.assertEqual([], batch['sequences'])
+
+    def test_summarize_qc_stats(self):
+        stats = read_qc.get_batch_qc_stats(['ACG', 'AT'], ['II5', '55'], 1, 5)
+
+        result = read_qc.summarize_qc_stats(stats)
+        self.assertEqual(2, result['reads'])
+        self.assertEqual(0.5, result['clipped_fraction'])
+        self.assertEqual({'2': 1, '3': 1}, result['length_counts'])
+        self.assertEqual(41, len(result['quality_counts']))
+        self.assertEqual(3, len(result['per_position']['mean_quality']))
+        self.assertEqual([1.0, 0.0, 0.0], result['per_position']['base_fractions']['A'])
+        self.assertEqual([0.0, 0.5, 0.0], result['per_position']['base_fractions']['T'])
+        self.assertEqual([30.0, 30.0, 20.0], result['per_position']['mean_quality'])
+
+def np_list(value):
+    return value.tolist() if hasattr(value, 'tolist') else value
+
+if __name__=='__main__':
+    unittest.main()
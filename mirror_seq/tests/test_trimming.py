@@ -1,5 +1,6 @@
 import unittest
 from mirror_seq import trimming
+import os
 
 class TestTrimming(unittest.TestCase):
     def test_trim_paired_seqs(self):
@@ -55,6 +56,28 @@ class TestTrimming(unittest.TestCase):
             self.assertEqual(self.trimmed_read1, fw1.read())
             self.assertEqual(self.trimmed_read2, fw2.read())
 
+    def test_filled_in_paired_end_trimming_qc(self):
+        import tempfile
+        import json
+
+        with tempfile.NamedTemporaryFile() as fw1, tempfile.NamedTemporaryFile() as fw2, \
+            tempfile.NamedTemporaryFile(suffix='.json') as qc_file:
+            trimming.filled_in_paired_end_trimming(self.r1_file.name,
+                self.r2_file.name, fw1.name, fw2.name, self.read_len,
+                qc_filename=qc_file.name)
+            fw1.seek(0)
+            self.assertEqual(self.trimmed_read1, fw1.read())
+            qc_file.seek(0)
+            result = json.load(qc_file)
+
+        self.assertEqual(['read1', 'read2'], sorted(result))
+        self.assertEqual(1, result['read1']['reads'])
+        self.assertEqual(1.0, result['read1']['clipped_fraction'])
+        self.assertEqual({'48': 1}, result['read1']['length_counts'])
+        self.assertEqual(1.0, result['read2']['clipped_fraction'])
+        self.assertEqual({'49': 1}, result['read2']['length_counts'])
+        self.assertEqual(1.0, result['read2']['per_position']['base_fractions']['A'][0])
+
     def test_filled_in_single_end_trimming(self):
         import tempfile
 
@@ -95,6 +118,29 @@ class TestTrimming(unittest.TestCase):
 
         self.assertEqual(expected_result, result)
 
+    def test_main_fill_in_trimming_read_len(self):
+        import tempfile
+        import subprocess
+
+        # mirror-seq finds the read length from the first read. Without it, read 1
+        # keeps its CGA fill-in.
+        out_dir = tempfile.mkdtemp()
+        out_filename = os.path.join(out_dir, os.path.basename(
+            os.path.splitext(self.r1_file.name)[0]) + '_trimmed.fastq')
+        try:
+            read_len = trimming.find_read_len(self.r1_file.name)
+            trimming.main(self.r1_file.name, self.r2_file.name, out_dir, True, read_len,
+                self.adapter1, self.adapter2)
+            with open(out_filename) as f:
+                self.assertEqual(self.trimmed_read1, f.read())
+
+            trimming.main(self.r1_file.name, self.r2_file.name, out_dir, True, None,
+                self.adapter1, self.adapter2)
+            with open(out_filename) as f:
+                self.assertEqual(self.read1, f.read())
+        finally:
+            subprocess.call(('rm', '-r', out_dir))
+
     @unittest.skip('Skip for now. Need a mock.')
     def test_run_trim_galore(self):
         import tempfile
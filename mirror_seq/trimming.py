@@ -42,7 +42,7 @@ def trim_paired_seqs(seq1, qual1, seq2, qual2, read_len):
     return seq1, qual1, seq2, qual2
 
 def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_filename,
-    out_read2_filename, read_len):
+    out_read2_filename, read_len, threads=1, qc_filename=None):
     ''' Trim off filled-in nucleotides from read1 and read 2 files.
 
     Parameters
@@ -57,15 +57,43 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
         The read 2 output filename.
     read_len : int
         The orignal read length from sequencer.
+    threads : int, optional
+        The number of threads which decompress each input file if it is in BGZF.
+    qc_filename : str, optional
+        If given, write read QC statistics of the trimmed reads into this JSON
+        file: per-position base composition and quality, the quality and length
+        histograms, and the fraction of read 1 with CGA clipped and of read 2
+        clipped. See read_qc.summarize_qc_stats().
 
+    Returns
+    -------
+    dict
+        The metrics record of this step.
+
+    Notes
+    -----
+    * The input files are read and decompressed in background threads, so that
+      overlaps with trimming.
+    * The QC statistics are collected in the same pass, so the trimmed files do
+      not need to be read again.
     '''
 
-    import pysam
     import os
     import gzip
     import subprocess
+    import time
+    from mirror_seq import fastq, read_qc
+    from mirror_seq import metrics as mt
 
-    fastq_file1 = pysam.FastxFile(read1_filename)
+    start_time = time.time()
+    read_count = 0
+    qc_stats = {}
+    qc_batches = {}
+    if qc_filename:
+        reads = ['read1', 'read2'] if read2_filename else ['read1']
+        qc_stats = {read: read_qc.make_qc_stats(read_len) for read in reads}
+        qc_batches = {read: read_qc.make_qc_batch() for read in reads}
+    fastq_file1 = fastq.read_fastq(read1_filename, threads)
     if out_read1_filename.endswith('.gz'):
         fw1 = open(out_read1_filename[:-3], 'w')
     else:
@@ -74,7 +102,7 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
     fastq_file2 = None
     fw2 = None
     if read2_filename:
-        fastq_file2 = pysam.FastxFile(read2_filename)
+        fastq_file2 = fastq.read_fastq(read2_filename, threads)
         if out_read2_filename.endswith('.gz'):
             fw2 = open(out_read2_filename[:-3], 'w')
         else:
@@ -83,6 +111,7 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
     for i, read1 in enumerate(fastq_file1):
         if i and i%1000000==0:
             print('{} reads processed'.format(i))
+        read_count += 1
 
         if fastq_file2:
             read2 = fastq_file2.next()
@@ -96,6 +125,13 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
         seq1, qual1, seq2, qual2 = trim_paired_seqs(read1.sequence, read1.quality,
             read2_sequence, read2_quality, read_len)
 
+        if qc_filename:
+            read_qc.add_qc_read(qc_stats['read1'], qc_batches['read1'], seq1, qual1,
+                len(seq1)<len(read1.sequence))
+            if seq2 is not None:
+                read_qc.add_qc_read(qc_stats['read2'], qc_batches['read2'], seq2, qual2,
+                    len(seq2)<len(read2_sequence))
+
         read_name_str1 = ' '.join([read1.name, read1.comment])
         fw1.write('@{}\n{}\n+\n{}\n'.format(read_name_str1, seq1, qual1))
         if seq2:
@@ -103,10 +139,13 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
             fw2.write('@{}\n{}\n+\n{}\n'.format(read_name_str2, seq2, qual2))
 
     fw1.close()
-    fastq_file1.close()
     if fw2:
         fw2.close()
-        fastq_file2.close()
+
+    if qc_filename:
+        for read, batch in qc_batches.iteritems():
+            read_qc.flush_qc_batch(qc_stats[read], batch)
+        read_qc.write_qc_report(qc_stats, qc_filename)
 
     if out_read1_filename.endswith('.gz'):
         print('Gziping the files')
@@ -114,6 +153,15 @@ def filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_file
         if out_read2_filename:
             subprocess.check_call(('gzip', '-f', fw2.name))
 
+    return mt.make_record(
+        'fill_in_trimming',
+        start_time,
+        name=out_read1_filename,
+        reads=read_count,
+        bytes_read=mt.get_file_size(read1_filename) + mt.get_file_size(read2_filename),
+        bytes_written=mt.get_file_size(out_read1_filename) + mt.get_file_size(out_read2_filename),
+    )
+
 def run_trim_galore(read1_filename, read2_filename, out_dir, adapter1, adapter2):
     '''  Run Trim galore!
 
@@ -151,8 +199,42 @@ def run_trim_galore(read1_filename, read2_filename, out_dir, adapter1, adapter2)
         cmd += [read1_filename]
     subprocess.check_output(cmd)
 
+def get_trimmed_filenames(read1_filename, read2_filename, out_dir):
+    ''' Get the output filenames of trimming.
+
+    Parameters
+    ----------
+    read1_filename : str
+        The read 1 filename in Fastq format with or without gzipped.
+    read2_filename : str
+        The read 2 filename in Fastq format with or without gzipped.
+    out_dir : str
+        The output directory.
+
+    Returns
+    -------
+    str
+        The trimmed read 1 filename.
+    str
+        The trimmed read 2 filename.
+    '''
+    import os
+
+    is_gzipped = read1_filename.endswith('.gz')
+    out_filename_template = os.path.join(out_dir, '{}_trimmed.fastq')
+    if is_gzipped:
+        prefix1 = os.path.splitext(os.path.splitext(read1_filename)[0])[0]
+        prefix2 = os.path.splitext(os.path.splitext(read2_filename)[0])[0]
+        out_filename_template += '.gz'
+    else:
+        prefix1 = os.path.splitext(read1_filename)[0]
+        prefix2 = os.path.splitext(read2_filename)[0]
+    prefix1 = os.path.basename(prefix1)
+    prefix2 = os.path.basename(prefix2)
+    return out_filename_template.format(prefix1), out_filename_template.format(prefix2)
+
 def main(read1_filename, read2_filename, out_dir, no_adapter_trimming, read_len,
-    adapter1, adapter2):
+    adapter1, adapter2, metrics_filename=None, threads=1, qc_filename=None):
     ''' Run the entire trimming.
 
     read1_filename : str
@@ -169,26 +251,33 @@ def main(read1_filename, read2_filename, out_dir, no_adapter_trimming, read_len,
         The adapter of read 1.
     adapter2 : str
         The adapter of read 2.
+    metrics_filename : str, optional
+        If given, write the performance metrics of trimming into this file.
+        JSON if it ends with ".json", otherwise TSV.
+    threads : int, optional
+        The number of threads which decompress each BGZF input in fill-in trimming.
+    qc_filename : str, optional
+        If given, write read QC statistics of the trimmed reads into this JSON file.
     '''
     import subprocess
     import os
+    import time
+    from mirror_seq import metrics as mt
 
     is_gzipped = read1_filename.endswith('.gz')
-    out_filename_template = os.path.join(out_dir, '{}_trimmed.fastq')
-    if is_gzipped:
-        prefix1 = os.path.splitext(os.path.splitext(read1_filename)[0])[0]
-        prefix2 = os.path.splitext(os.path.splitext(read2_filename)[0])[0]
-        out_filename_template += '.gz'
-    else:
-        prefix1 = os.path.splitext(read1_filename)[0]
-        prefix2 = os.path.splitext(read2_filename)[0]
-    prefix1 = os.path.basename(prefix1)
-    prefix2 = os.path.basename(prefix2)
-    out_read1_filename = out_filename_template.format(prefix1)
-    out_read2_filename = out_filename_template.format(prefix2)
+    out_read1_filename, out_read2_filename = get_trimmed_filenames(read1_filename,
+        read2_filename, out_dir)
+    records = []
     # Trim_galore
     if not no_adapter_trimming:
+        start_time = time.time()
         run_trim_galore(read1_filename, read2_filename, out_dir, adapter1, adapter2)
+        records.append(mt.make_record(
+            'adapter_trimming',
+            start_time,
+            name=read1_filename,
+            bytes_read=mt.get_file_size(read1_filename) + mt.get_file_size(read2_filename),
+        ))
         if is_gzipped:
             read1_filename = os.path.join(out_dir,
                 '{}_val_1.fq.gz'.format(os.path.basename(
@@ -204,8 +293,10 @@ def main(read1_filename, read2_filename, out_dir, no_adapter_trimming, read_len,
             read2_filename = os.path.join(out_dir,
                 '{}_val_2.fq'.format(os.path.basename(os.path.splitext(read2_filename)[0])))
     # Fill-in trimming.
-    filled_in_paired_end_trimming(read1_filename, read2_filename, out_read1_filename,
-        out_read2_filename, read_len)
+    records.append(filled_in_paired_end_trimming(read1_filename, read2_filename,
+        out_read1_filename, out_read2_filename, read_len, threads, qc_filename))
+    if metrics_filename:
+        mt.write_metrics(records, metrics_filename)
     print('done!')
 
 def find_read_len(filename):
@@ -221,10 +312,9 @@ def find_read_len(filename):
     int
         Read length.
     '''
-    import os
-    import pysam
+    from mirror_seq import fastq
 
-    fastq_file = pysam.FastxFile(filename)
+    fastq_file = fastq.read_fastq(filename)
     read = fastq_file.next()
     fastq_file.close()
 
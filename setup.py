@@ -20,7 +20,8 @@ setup(name='mirror_seq',
     author='Hunter Chung',
     author_email='b89603112@gmail.com',
     licence='Apache License 2.0',
-    scripts=['bin/mirror-seq', 'bin/mirror-trim', 'bin/mirror-call'],
+    scripts=['bin/mirror-seq', 'bin/mirror-trim', 'bin/mirror-call', 'bin/mirror-merge-shards',
+        'bin/mirror-merge'],
     packages=['mirror_seq'],
     test_suite='nose.collector',
     tests_require=['nose'],